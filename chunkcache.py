@@ -0,0 +1,105 @@
+import os
+import os.path
+from collections import OrderedDict
+
+from PIL import Image
+
+from util import *
+
+DEFAULT_CHUNK_CACHE_BYTES = 256 * 1024 * 1024
+
+# rough per-entry bookkeeping cost, added to the image size of a cached chunk
+CHUNK_OVERHEAD = 256
+
+
+class Chunk(object):
+    """A rendered chunk: the part of the chunk image that was drawn on (None if
+    nothing was), where that part starts in the full chunk, and the maxy of its nodes"""
+    def __init__(self, image, offset, maxy):
+        self.image = image
+        self.offset = offset
+        self.maxy = maxy
+        self.nbytes = CHUNK_OVERHEAD
+        if image is not None:
+            self.nbytes += image.width * image.height * 4
+
+
+class ChunkCache(StatCounters):
+    """LRU cache of rendered chunks, bounded by the bytes of their images. Chunks are
+    keyed by column and the timestamps of its blocks, so a chunk isn't reused once
+    one of its blocks has been saved again. With spill_dir, evicted chunks are
+    written there and read back (and removed from there) when asked for again, instead
+    of being rendered again."""
+    STAT_COUNTERS = ("hits", "misses", "spill_hits")
+
+    def __init__(self, max_bytes, spill_dir=None):
+        self.max_bytes = max_bytes
+        self.spill_dir = spill_dir
+        self.chunks = OrderedDict()
+        # key -> (path, size, offset, maxy) of the chunks in spill_dir
+        self.spilled = {}
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.spill_hits = 0
+
+    def get(self, key):
+        chunk = self.chunks.get(key)
+        if chunk is not None:
+            self.chunks.move_to_end(key)
+            self.hits += 1
+            return chunk
+        spilled = self.spilled.pop(key, None)
+        if spilled is None:
+            self.misses += 1
+            return None
+        path, size, offset, maxy = spilled
+        image = None
+        if path is not None:
+            with open(path, "rb") as f:
+                image = Image.frombytes("RGBA", size, f.read())
+            # it is held in memory again, and only written out again if it is evicted again
+            os.remove(path)
+        self.spill_hits += 1
+        chunk = Chunk(image, offset, maxy)
+        self.put(key, chunk)
+        return chunk
+
+    def put(self, key, chunk):
+        if self.max_bytes <= 0:
+            return
+        old = self.chunks.pop(key, None)
+        if old is not None:
+            self.size -= old.nbytes
+        self.chunks[key] = chunk
+        self.size += chunk.nbytes
+        while self.size > self.max_bytes:
+            evicted_key, evicted = self.chunks.popitem(last=False)
+            self.size -= evicted.nbytes
+            if self.spill_dir is not None and evicted_key not in self.spilled:
+                self.spill(evicted_key, evicted)
+
+    def spill(self, key, chunk):
+        path = None
+        size = None
+        if chunk.image is not None:
+            cx, cz, timestamps = key
+            path = os.path.join(self.spill_dir, "%d_%d_%d_%x.rgba" % (
+                os.getpid(), cx, cz, hash(timestamps) & 0xffffffff,
+            ))
+            size = chunk.image.size
+            # raw pixels, encoding a PNG takes about as long as rendering the chunk again
+            with open(path, "wb") as f:
+                f.write(chunk.image.tobytes())
+        self.spilled[key] = (path, size, chunk.offset, chunk.maxy)
+
+    def summary(self):
+        lookups = self.hits + self.spill_hits + self.misses
+        return "chunk cache: %d hits, %d read back from disk, %d misses (%.1f%% hit rate), %d chunks / %.1f MB held" % (
+            self.hits,
+            self.spill_hits,
+            self.misses,
+            100.0 * (self.hits + self.spill_hits) / lookups if lookups else 0.0,
+            len(self.chunks),
+            self.size / (1024 * 1024),
+        )
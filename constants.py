@@ -13,6 +13,10 @@ NODES_PER_BLOCK = 16
 BLOCK_SIZE = 16 * NODE_SIZE
 CHUNK_HEIGHT = 16 * BLOCK_SIZE//2 + BLOCK_SIZE//2
 BLOCKS_PER_CHUNK = 16
+# a strip tile can be reached by the chunks of this many strip steps before it
+STRIP_TILE_REACH = (CHUNK_HEIGHT + BLOCK_SIZE // 4 - 1) // (BLOCK_SIZE // 2)
+# rows below the top of the next tile of a strip that chunks3 can still draw into
+STRIP_WINDOW = CHUNK_HEIGHT + BLOCK_SIZE // 4
 
 # XY Project specific stuff - move later
 MAX_XY_WORLD_SIZE = 8192
@@ -1,15 +1,94 @@
 import sqlite3
-import io
+import struct
+import hashlib
 import zlib
 import zstandard
-import array
+import numpy
 import os.path
+from collections import OrderedDict
 from util import *
 
+# u16 node_id, u16 name_len
+NAME_ID_ENTRY = struct.Struct(">HH")
+# u8 type, s32 x, s32 y, s32 z, u16 data_size
+STATIC_OBJECT = struct.Struct(">BiiiH")
+# u16 position, s32 timeout, s32 elapsed
+NODE_TIMER = struct.Struct(">Hii")
+
+# output size per step when inflating a zlib stream only to find its end
+ZLIB_SKIP_CHUNK = 16384
+
+# node array of a block that is entirely content id 0
+EMPTY_NODES = numpy.zeros((16, 16, 16), dtype=numpy.uint16)
+
+
+# rough per-object bookkeeping cost, added to the buffer sizes of a cached block
+BLOCK_OVERHEAD = 512
+
+DEFAULT_CACHE_BYTES = 256 * 1024 * 1024
+
+
+def blockHash(data):
+    """Short digest of the raw data of a block, to tell whether it changed"""
+    return hashlib.blake2b(data, digest_size=8).digest()
+
+
+class BlockCache(StatCounters):
+    """LRU cache of decoded blocks, bounded by the estimated bytes they hold"""
+    STAT_COUNTERS = ("hits", "misses", "evictions")
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.blocks = OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, pos):
+        block = self.blocks.get(pos)
+        if block is None:
+            self.misses += 1
+            return None
+        self.blocks.move_to_end(pos)
+        self.hits += 1
+        return block
+
+    def put(self, pos, block):
+        if self.max_bytes <= 0:
+            return
+        old = self.blocks.pop(pos, None)
+        if old is not None:
+            self.size -= old.nbytes
+        self.blocks[pos] = block
+        self.size += block.nbytes
+        while self.size > self.max_bytes:
+            _, evicted = self.blocks.popitem(last=False)
+            self.size -= evicted.nbytes
+            self.evictions += 1
+
+    def summary(self):
+        lookups = self.hits + self.misses
+        return "block cache: %d hits, %d misses (%.1f%% hit rate), %d evictions, %d blocks / %.1f MB held" % (
+            self.hits,
+            self.misses,
+            100.0 * self.hits / lookups if lookups else 0.0,
+            self.evictions,
+            len(self.blocks),
+            self.size / (1024 * 1024),
+        )
+
 
 class Map(object):
-    def __init__(self, path):
+    def __init__(self, path, cache_bytes=DEFAULT_CACHE_BYTES, node_data_only=True, invisible=frozenset()):
+        """With node_data_only, blocks are decoded only as far as the renderer needs
+        (node ids and the name-id mapping), everything else is skipped over.
+        invisible are the names of the nodes that are never drawn (see NodeRegistry),
+        blocks of only those are empty"""
         self.conn = sqlite3.connect(os.path.join(path, "map.sqlite"))
+        self.cache = BlockCache(cache_bytes)
+        self.node_data_only = node_data_only
+        self.invisible = invisible
 
     def getCoordinatesToDraw(self):
         result = set()
@@ -23,163 +102,271 @@ class Map(object):
             result.add(coordsToGrid(x, z))
         return result
 
-    def getBlock(self, x, y, z):
+    def iterBlockPositions(self):
+        """Yields (x, y, z) of every block in the map, ordered by pos, which is by z first"""
+        cur = self.conn.cursor()
+        cur.execute("SELECT `pos` FROM `blocks` ORDER BY `pos`")
+        for pos, in cur:
+            yield getIntegerAsBlock(pos)
+
+    def rowidIsPos(self):
+        """Whether pos is declared INTEGER PRIMARY KEY, which makes the rowid the pos itself"""
+        cur = self.conn.cursor()
+        cur.execute("PRAGMA table_info(`blocks`)")
+        return any(name == "pos" and type.upper() == "INTEGER" and pk for _, name, type, _, _, pk in cur)
+
+    def iterBlockStamps(self):
+        """Yields (pos, stamp) for every block, ordered by pos. The stamp is the rowid of the
+        block, which changes whenever the block is saved: Minetest replaces its row, and
+        the new row gets a rowid above all others (see RenderState.changedBlocks for the
+        one exception). Unlike the timestamp in the block data, it is read from the index
+        on pos alone, without reading or decompressing any block. The stamp is None
+        if the rowid is the pos itself (see rowidIsPos)"""
+        rowid_is_pos = self.rowidIsPos()
         cur = self.conn.cursor()
-        cur.execute("SELECT `data` FROM `blocks` WHERE `pos`==? LIMIT 1", (getBlockAsInteger(x, y, z), ))
-        r = cur.fetchone()
-        if not r:
-            return DummyMapBlock()
-        f = io.BytesIO(r[0])
-        version = readU8(f)
+        cur.execute("SELECT `pos`, `rowid` FROM `blocks` ORDER BY `pos`")
+        for pos, stamp in cur:
+            yield pos, None if rowid_is_pos else stamp
+
+    def queryBlocks(self, column, positions):
+        """Yields (pos, column) of the blocks at positions (pos integers) that exist"""
+        return queryIn(self.conn, "SELECT `pos`, " + column + " FROM `blocks` WHERE `pos` IN (%s)", positions)
+
+    def getBlockStamps(self, positions):
+        """Stamp (see iterBlockStamps) of the blocks at positions (pos integers), as a dict
+        of pos -> stamp, without the missing ones"""
+        rowid_is_pos = self.rowidIsPos()
+        return {pos: None if rowid_is_pos else stamp for pos, stamp in self.queryBlocks("`rowid`", positions)}
+
+    def getBlockHashes(self, positions):
+        """Hash of the raw data of the blocks at positions (pos integers), as a dict of
+        pos -> hash, without the missing ones. Hashing the stored blob is much cheaper
+        than decoding it"""
+        return {pos: blockHash(data) for pos, data in self.queryBlocks("`data`", positions)}
+
+    def getBlock(self, x, y, z):
+        return self.getBlocks([(x, y, z)])[(x, y, z)]
+
+    def getColumn(self, x, z, y_range):
+        """Fetch the blocks at (x, y, z) for every y in y_range, in order"""
+        blocks = self.getBlocks([(x, y, z) for y in y_range])
+        return [blocks[(x, y, z)] for y in y_range]
+
+    def getBlocks(self, positions):
+        """Fetch many blocks with as few queries as possible.
+        Returns a dict of (x, y, z) -> MapBlock, missing blocks are DummyMapBlocks"""
+        wanted = {}
+        result = {}
+        for x, y, z in positions:
+            pos = getBlockAsInteger(x, y, z)
+            if pos in wanted:
+                continue
+            block = self.cache.get(pos)
+            if block is not None:
+                result[(x, y, z)] = block
+            else:
+                wanted[pos] = (x, y, z)
+        for pos, data in self.queryBlocks("`data`", wanted):
+            block = self.parseBlock(data)
+            self.cache.put(pos, block)
+            result[wanted[pos]] = block
+        for pos, coords in wanted.items():
+            if coords not in result:
+                # remember missing blocks too, they are just as likely to be asked for again
+                block = DummyMapBlock()
+                self.cache.put(pos, block)
+                result[coords] = block
+        return result
+
+    def parseBlock(self, data):
+        version = data[0]
 
         # decompress the whole block with zstd (version >= 29)
         if version >= 29:
             dctx = zstandard.ZstdDecompressor()
             dobj = dctx.decompressobj()
-            decompressed = array.array("B", dobj.decompress(f.read()))
-            f.close()
-            f = io.BytesIO(decompressed)
-
-        flags = f.read(1)
+            f = Reader(dobj.decompress(memoryview(data)[1:]))
+        else:
+            f = Reader(data, 1)
 
-        # Check flags
-        is_underground = ((ord(flags) & 1) != 0)
-        day_night_differs = ((ord(flags) & 2) != 0)
-        lighting_expired = ((ord(flags) & 4) != 0)
-        generated = ((ord(flags) & 8) != 0)
+        flags = f.u8()
 
         if version >= 27:
-            lighting_complete = readU16(f)
+            lighting_complete = f.u16()
 
         if version >= 29:
-            timestamp = readU32(f)
-            id_to_name = {}
-            name_id_mapping_version = readU8(f)
-            num_name_id_mappings = readU16(f)
-            for i in range(0, num_name_id_mappings):
-                node_id = readU16(f)
-                name_len = readU16(f)
-                name = f.read(name_len)
-                id_to_name[node_id] = name
-            #print(id_to_name)
+            timestamp = f.u32()
+            id_to_name = self.parseNameIdMapping(f)
 
         if version >= 22:
-            content_width = readU8(f)
-            params_width = readU8(f)
+            content_width = f.u8()
+            params_width = f.u8()
 
         # Node data
-        if version < 29:
+        if version < 29 and self.node_data_only:
+            try:
+                # param0 only, param1 and param2 are never looked at
+                mapdata = readZlibPrefix(f, 4096*2)
+            except zlib.error:
+                return MapBlock({}, b"")
+        elif version < 29:
             dec_o = zlib.decompressobj()
+            rest = f.rest()
             try:
-                mapdata = array.array("B", dec_o.decompress(f.read()))
-            except:
-                mapdata = []
-            # Reuse the unused tail of the file
-            f.close()
-            f = io.BytesIO(dec_o.unused_data)
+                mapdata = dec_o.decompress(rest)
+            except zlib.error:
+                # nothing after this can be located, so draw the block as empty
+                return MapBlock({}, b"")
+            # Continue right after the compressed stream
+            f.skip(len(rest) - len(dec_o.unused_data))
         else:
             if content_width == 1:
-                mapdata = array.array("B", f.read(4096*3))
+                mapdata = f.read(4096*3)
             else:
-                mapdata = array.array("B", f.read(4096*4))
+                mapdata = f.read(4096*4)
 
-        ### note - for v29, everything is parsed correctly up to here at least
-        # we have all we need at this point, so return
-        # also, there's some bug with the parsing or decompression for 29+
-        # so it will fail after this anyway - TBD
-        if version >= 29:
-            return MapBlock(id_to_name, mapdata)
+        # the mapping comes first in v29, so there is nothing left that we need
+        if version >= 29 and self.node_data_only:
+            return MapBlock(id_to_name, mapdata, flags=flags, timestamp=timestamp, invisible=self.invisible)
 
         # zlib-compressed node metadata list
         if version < 29:
-            dec_o = zlib.decompressobj()
             try:
-                metaliststr = array.array("B", dec_o.decompress(f.read()))
-                # And do nothing with it
-            except:
-                metaliststr = []
-
-            # Reuse the unused tail of the file
-            f.close()
-            f = io.BytesIO(dec_o.unused_data)
-            data_after_node_metadata = dec_o.unused_data
+                if self.node_data_only:
+                    readZlibPrefix(f, 0)
+                else:
+                    dec_o = zlib.decompressobj()
+                    rest = f.rest()
+                    # And do nothing with it
+                    dec_o.decompress(rest)
+                    f.skip(len(rest) - len(dec_o.unused_data))
+            except zlib.error:
+                # the name-id mapping comes after it and can't be located, keep only the node data
+                return MapBlock({}, mapdata, flags=flags)
         else:
-            meta_version = readU8(f) # should be 2
-            meta_count = readU16(f)
-            for i in range(0, meta_count):
-                meta_pos = readU16(f)
-                meta_num_vars = readU32(f)
-                for j in range(0, meta_num_vars):
-                    key_len = readU16(f)
-                    f.read(key_len)
-                    val_len = readU32(f)
-                    f.read(val_len)
-                    if meta_version >= 2:
-                        readU8(f)
+            meta_version = f.u8() # 0 if there is no metadata, 2 otherwise
+            if meta_version != 0:
+                meta_count = f.u16()
+                for i in range(0, meta_count):
+                    meta_pos = f.u16()
+                    meta_num_vars = f.u32()
+                    for j in range(0, meta_num_vars):
+                        f.skip(f.u16())
+                        f.skip(f.u32())
+                        if meta_version >= 2:
+                            f.skip(1)
+                    # the inventory is serialized as text
+                    end = f.find(b"EndInventory\n")
+                    if end < 0:
+                        # nothing after it can be located, keep what was read so far
+                        return MapBlock(id_to_name, mapdata, flags=flags, timestamp=timestamp, invisible=self.invisible)
+                    f.pos = end + len(b"EndInventory\n")
 
         if version <= 21:
             # mapblockobject_count
-            readU16(f)
+            f.skip(2)
 
         if version == 23:
-            readU8(f)  # Unused node timer version (always 0)
+            f.skip(1)  # Unused node timer version (always 0)
         if version == 24:
-            ver = readU8(f)
+            ver = f.u8()
             if ver == 1:
-                num = readU16(f)
-                for i in range(0, num):
-                    readU16(f)
-                    readS32(f)
-                    readS32(f)
-
-        static_object_version = readU8(f)
-        static_object_count = readU16(f)
+                num = f.u16()
+                f.skip(num * NODE_TIMER.size)
+
+        static_object_version = f.u8()
+        static_object_count = f.u16()
         for i in range(0, static_object_count):
-            # u8 type (object type-id)
-            object_type = readU8(f)
-            # s32 pos_x_nodes * 10000
-            pos_x_nodes = readS32(f) / 10000
-            # s32 pos_y_nodes * 10000
-            pos_y_nodes = readS32(f) / 10000
-            # s32 pos_z_nodes * 10000
-            pos_z_nodes = readS32(f) / 10000
-            # u16 data_size
-            data_size = readU16(f)
+            if self.node_data_only:
+                # only data_size is needed to get past the object
+                f.skip(STATIC_OBJECT.size - 2)
+                f.skip(f.u16())
+                continue
+            # u8 type, s32 pos_x_nodes * 10000, s32 pos_y_nodes * 10000,
+            # s32 pos_z_nodes * 10000, u16 data_size
+            object_type, pos_x, pos_y, pos_z, data_size = f.unpack(STATIC_OBJECT)
             # u8[data_size] data
-            data = f.read(data_size)
+            f.skip(data_size)
 
         if version < 29:
-            timestamp = readU32(f)
+            timestamp = f.u32()
 
             id_to_name = {}
             if version >= 22:
-                name_id_mapping_version = readU8(f)
-                num_name_id_mappings = readU16(f)
-                for i in range(0, num_name_id_mappings):
-                    node_id = readU16(f)
-                    name_len = readU16(f)
-                    name = f.read(name_len)
-                    id_to_name[node_id] = name
+                id_to_name = self.parseNameIdMapping(f)
 
         # Node timers
-        if version >= 25:
-            timer_size = readU8(f)
-            num = readU16(f)
-            for i in range(0, num):
-                readU16(f)
-                readS32(f)
-                readS32(f)
+        if version >= 25 and not self.node_data_only:
+            timer_size = f.u8()
+            num = f.u16()
+            f.skip(num * timer_size)
+
+        return MapBlock(id_to_name, mapdata, flags=flags, timestamp=timestamp, invisible=self.invisible)
 
-        #print(id_to_name)
-        #print(mapdata)
-        return MapBlock(id_to_name, mapdata)
+    @staticmethod
+    def parseNameIdMapping(f):
+        id_to_name = {}
+        name_id_mapping_version = f.u8()
+        num_name_id_mappings = f.u16()
+        for i in range(0, num_name_id_mappings):
+            node_id, name_len = f.unpack(NAME_ID_ENTRY)
+            id_to_name[node_id] = bytes(f.read(name_len))
+        return id_to_name
+
+
+def readZlibPrefix(f, length):
+    """Inflate only the first length bytes of the zlib stream at the reader and move
+    the reader past the whole stream. The rest of the output is produced in small
+    pieces that are thrown away, since the stream end is only known by inflating it."""
+    dec_o = zlib.decompressobj()
+    rest = f.rest()
+    prefix = dec_o.decompress(rest, length) if length else b""
+    tail = dec_o.unconsumed_tail if length else rest
+    while not dec_o.eof:
+        if not dec_o.decompress(tail, ZLIB_SKIP_CHUNK) and not tail:
+            # truncated stream
+            break
+        tail = dec_o.unconsumed_tail
+    f.skip(len(rest) - len(dec_o.unused_data))
+    return prefix
 
 
 class MapBlock(object):
-    def __init__(self, id_to_name, mapdata, version=99):
+    def __init__(self, id_to_name, mapdata, version=99, flags=0, timestamp=None, invisible=frozenset()):
         self.id_to_name = id_to_name
         self.mapdata = mapdata
         self.version = version
+        # game time of the last save of the block, None if unknown
+        self.timestamp = timestamp
+
+        # Check flags
+        self.is_underground = ((flags & 1) != 0)
+        self.day_night_differs = ((flags & 2) != 0)
+        self.lighting_expired = ((flags & 4) != 0)
+        # 0x08 is set while the block is not generated yet
+        self.generated = ((flags & 8) == 0)
+        # nothing in the mapping can be drawn, so no node of this block can either
+        self.is_empty = all(name in invisible for name in id_to_name.values())
+
+        # content ids as a [z][y][x] view over the big-endian param0 data, no copy is made
+        if len(mapdata) >= 4096 * 2:
+            self.nodes = numpy.frombuffer(mapdata, dtype=">u2", count=4096).reshape(16, 16, 16)
+        else:
+            self.nodes = EMPTY_NODES
+        # local index -> name, content ids missing from the mapping end up as "ignore"
+        ids = sorted(id_to_name)
+        self.names = [id_to_name[i] for i in ids] + [b"ignore"]
+        # content id -> local index
+        self.id_to_index = numpy.full(max(ids + [int(self.nodes.max())]) + 1, len(ids), dtype=numpy.uint16)
+        self.id_to_index[ids] = numpy.arange(len(ids), dtype=numpy.uint16)
+        # local index -> sprite slot, filled in by the renderer
+        self.sprite_ids = None
+        self.nbytes = (
+            BLOCK_OVERHEAD
+            + len(mapdata)
+            + self.id_to_index.nbytes
+            + sum(len(name) for name in self.names)
+        )
 
     def get(self, x, y, z):
         datapos = x + y * 16 + z * 256
@@ -188,7 +375,24 @@ class MapBlock(object):
         #print(self.mapdata)
         return self.id_to_name[(self.mapdata[datapos * 2] << 8) | (self.mapdata[datapos * 2 + 1])]
 
+    def local_nodes(self):
+        """Local indices (into self.names) of all nodes, as a [z][y][x] array"""
+        return self.id_to_index[self.nodes]
+
 
 class DummyMapBlock(object):
+    is_underground = False
+    generated = False
+    is_empty = True
+    timestamp = None
+    nodes = EMPTY_NODES
+    names = [b"air"]
+    id_to_index = numpy.zeros(1, dtype=numpy.uint16)
+    sprite_ids = None
+    nbytes = BLOCK_OVERHEAD
+
     def get(self, x, y, z):
         return "default:air"
+
+    def local_nodes(self):
+        return EMPTY_NODES
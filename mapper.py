@@ -4,138 +4,226 @@ import os
 import sys
 import argparse
 import time
-
+import multiprocessing
+import queue
+import tempfile
+import shutil
+import atexit
+import json
+from collections import Counter
+
+import numpy
 from PIL import Image, ImageDraw
 
-from map import Map
-from blocks import build_block, build_full_block, build_sprite, build_billboard, alpha_over, build_full_transparent_block
+from map import Map, DEFAULT_CACHE_BYTES
+from renderstate import RenderState, PlotIndex, stripTiles, stripColumns, footprintPositions, footprintHashes
+from chunkcache import ChunkCache, Chunk, DEFAULT_CHUNK_CACHE_BYTES
+from pyramid import Pyramid, PyramidSchedule, BASE_ZOOM, DEFAULT_TILE_CACHE_BYTES
+from topdown import TopDownMapper, TOPDOWN_SCALES, TOPDOWN_ROOT, render_topdown
+from nodetable import SpriteAtlas, texturesKey
+from onomatopoeia.c_overviewer import draw_block
 from constants import *
 from util import *
-import node_definitions
+from registry import loadRegistry
+
+
+# global id (and sprite slot) of nodes that are never drawn
+INVISIBLE_NODE_ID = -1
+
+
+def orientNodes(nodes, orientation):
+    """Turn a [z][y][x] node array into a [y][z][x] one in drawing order for the orientation"""
+    nodes = nodes.transpose(1, 0, 2)
+    if orientation == 1:
+        return nodes[:, ::-1, ::-1]
+    elif orientation == 2:
+        return nodes[:, ::-1, :]
+    elif orientation == 4:
+        return nodes[:, :, ::-1]
+    return nodes
+
+
+# world (x, y, z) offset of the neighbouring node on the +y, +z and +x sides in
+# drawing order (see orientNodes), per orientation
+DRAWING_NEIGHBOURS = {
+    1: ((0, 1, 0), (0, 0, -1), (-1, 0, 0)),
+    2: ((0, 1, 0), (0, 0, -1), (1, 0, 0)),
+    3: ((0, 1, 0), (0, 0, 1), (1, 0, 0)),
+    4: ((0, 1, 0), (0, 0, 1), (-1, 0, 0)),
+}
+
+
+def plotFilename(xy_x, xy_y, orientation):
+    return "mapxy-%d-%d-%d.png" % (xy_x, xy_y, orientation)
+
+
+def drawingExtent(xs, ys, zs):
+    """Box (left, top, right, bottom) of all pixels that blocks drawn at the positions in
+    the ranges xs, ys and zs (the drawing position dx, dy, dz of drawBlockAt) can cover,
+    relative to the start passed to drawBlockAt"""
+    # nodes are up to this far off the position of their block, in both directions
+    reach = NODE_SIZE // 2 * (NODES_PER_BLOCK - 1)
+    return (
+        NODE_SIZE // 2 * NODES_PER_BLOCK * (zs[0] - xs[-1]) - reach,
+        NODE_SIZE // 4 * NODES_PER_BLOCK * (xs[0] + zs[0] - 2 * ys[-1]) - reach,
+        NODE_SIZE // 2 * NODES_PER_BLOCK * (zs[-1] - xs[0]) + reach + NODE_SIZE,
+        NODE_SIZE // 4 * NODES_PER_BLOCK * (xs[-1] + zs[-1] - 2 * ys[0]) + reach + NODE_SIZE,
+    )
 
 
-class Mapper:
-    def __init__(self, map):
+class Mapper(StatCounters):
+    # the counters that are summed up over worker processes
+    STAT_COUNTERS = (
+        "cnt", "drawn_blocks", "skipped_blocks", "drawn_nodes", "culled_nodes", "unknown_nodes", "chunk_cache", "sprites"
+    )
+
+    def __init__(self, map, tile_cache_bytes=0, chunk_cache_bytes=DEFAULT_CHUNK_CACHE_BYTES, chunk_spill_dir=None):
         self.map = map
+        self.chunk_cache = ChunkCache(chunk_cache_bytes, chunk_spill_dir)
+        # keeps the tiles around for joining the zoom levels when that happens in this process
+        self.pyramid = Pyramid(tile_cache_bytes)
         self.cnt = 0
         self.available_tiles = set()
+        # (x, z, steps) of every strip rendered by stupidMakeTiles
+        self.strips = []
+        self.drawn_blocks = 0
+        self.skipped_blocks = 0
+        self.drawn_nodes = 0
+        self.culled_nodes = 0
+        # sprite slots per block while drawing a plot in several orientations, see spriteNodes
+        self.sprite_nodes = None
         self.set_up_images()
 
     def set_up_images(self):
-        """Generate an image for each node and load the mask"""
-        self.node_images = {}
-        self.masks = {}
-        textures = node_definitions.NODE_TEXTURES
-        default_mask = Image.open("mask.png").convert("1")
-        for node_name, (texture_top, texture_side, texture_bottom) in textures.items():
-            top = Image.open(os.path.join("textures", texture_top)).convert("RGBA") if texture_top != "" else None
-            side = Image.open(os.path.join("textures", texture_side)).convert("RGBA") if texture_side != "" else None
-            bottom = Image.open(os.path.join("textures", texture_bottom)).convert("RGBA") if texture_bottom != "" else None
-            # only bottom texture, means it is a flat block, like lily pads
-            if bottom != None and top == None and side == None:
-                self.node_images[str.encode(node_name, "ascii")] = build_full_block(None, None, None, None, None, bottom)
-                self.masks[str.encode(node_name, "ascii")] = None
-            # only side texture, means it is a sprite, like flowers
-            elif side != None and top == None and bottom == None:
-                self.node_images[str.encode(node_name, "ascii")] = build_sprite(side)
-                self.masks[str.encode(node_name, "ascii")] = None
-            # only top texture, means it is a billboard block, like reeds
-            elif top != None and side == None and bottom == None:
-                self.node_images[str.encode(node_name, "ascii")] = build_billboard(top)
-                self.masks[str.encode(node_name, "ascii")] = None
-            # all textures, means it is a full block but designed to be transparent, like water
-            elif top != None and side != None and bottom != None:
-                # leave out the back sides for now, to make it appear even more transparent
-                self.node_images[str.encode(node_name, "ascii")] = build_full_transparent_block(top, None, None, side, side, bottom)
-                self.masks[str.encode(node_name, "ascii")] = None
-            # otherwise, build a regular block
-            else:
-                self.node_images[str.encode(node_name, "ascii")] = build_block(top, side)
-                self.masks[str.encode(node_name, "ascii")] = None # or default_mask if you don't want to use alpha channel from the textures
-
-    def drawNode(self, canvas, x, y, z, block, start, mask):
-        """Draw the three sides of a single node"""
-        if mask == None:
-            mask = block
-        #canvas.paste(
-        alpha_over(
+        """Set up the atlas of the node images for draw_block, see nodetable.py
+        Every node name gets an integer id, every distinct set of textures a slot in the atlas,
+        which indexes opaque"""
+        # INVISIBLE_NODE_ID for the nodes that are never drawn
+        self.node_ids = loadRegistry().ids
+        self.unknown_nodes = Counter()
+        self.unknown_node_id = self.node_ids[b"UNKNOWN_NODE"]
+        # the node images for draw_block, only built when a block using them is drawn (see spriteIds)
+        # or SpriteAtlas(mask=Image.open("mask.png").convert("1")) if you don't want to use alpha channel from the textures
+        self.sprites = SpriteAtlas()
+        self.atlas = self.sprites.image
+        # indexed by sprite slot, filled in along with the images, INVISIBLE_NODE_ID (-1) is never opaque
+        self.opaque = self.sprites.opaque
+
+    def nodeId(self, node_name):
+        """Global id of a node name, INVISIBLE_NODE_ID for nodes that are not drawn"""
+        return self.node_ids.get(node_name, self.unknown_node_id)
+
+    def spriteIds(self, map_block):
+        """Array mapping the local node indices of map_block to their sprite slots in the atlas
+        (see SpriteAtlas, nodes with the same textures share one).
+        Built once per decoded block and kept with it"""
+        if map_block.sprite_ids is None:
+            map_block.sprite_ids = self.sprites.slots(
+                numpy.array([self.nodeId(name) for name in map_block.names], dtype=numpy.int32)
+            )
+            self.sprites.require(map_block.sprite_ids)
+            unknown = [
+                local for local, name in enumerate(map_block.names)
+                if name not in self.node_ids
+            ]
+            if unknown:
+                counts = numpy.bincount(map_block.local_nodes().ravel(), minlength=len(map_block.names))
+                for local in unknown:
+                    if counts[local]:
+                        self.unknown_nodes[map_block.names[local]] += int(counts[local])
+        return map_block.sprite_ids
+
+    def spriteNodes(self, map_block):
+        """Sprite slots of the nodes of map_block as a [z][y][x] array. Kept while sprite_nodes
+        is set, for blocks that are drawn more than once"""
+        if self.sprite_nodes is None:
+            return self.spriteIds(map_block)[map_block.local_nodes()]
+        nodes = self.sprite_nodes.get(id(map_block))
+        if nodes is None:
+            nodes = self.sprite_nodes[id(map_block)] = self.spriteIds(map_block)[map_block.local_nodes()]
+        return nodes
+
+    def drawBlock(self, canvas, bx, by, bz, start, map_block=None, covering=(None, None, None)):
+        return self.drawBlockAt(canvas, bx, by, bz, bx, by, bz, start, 3, map_block, covering)
+
+    def drawBlockAt(self, canvas, bx, by, bz, dx, dy, dz, start, orientation, map_block=None, covering=(None, None, None)):
+        """ returns max y of visible node
+        map_block can be passed in if it was already fetched (see Map.getBlocks)
+        covering are the blocks drawn after this one on the same canvas, see cullHidden """
+        if map_block is None:
+            map_block = self.map.getBlock(bx, by, bz)
+        maxy = -1
+        if map_block.is_empty or not map_block.generated:
+            self.skipped_blocks += 1
+            return maxy
+        self.drawn_blocks += 1
+        # sprite slots in drawing order: [y][z][x]
+        node_ids = orientNodes(self.spriteNodes(map_block), orientation)
+        layers = numpy.flatnonzero((node_ids != INVISIBLE_NODE_ID).any(axis=(1, 2)))
+        if len(layers) == 0:
+            return maxy
+        maxy = int(layers[-1]) + dy * NODES_PER_BLOCK
+        node_ids = self.cullHidden(node_ids, orientation, covering)
+        self.drawn_nodes += draw_block(
             canvas,
-            block,
+            self.atlas,
+            node_ids,
             (
-                start[0] + NODE_SIZE // 2 * (z - x),
-                start[1] + NODE_SIZE // 4 * (x + z - 2 * y),
+                start[0] + NODE_SIZE // 2 * NODES_PER_BLOCK * (dz - dx),
+                start[1] + NODE_SIZE // 4 * NODES_PER_BLOCK * (dx + dz - 2 * dy),
             ),
-            mask,
+            orientation == 2 or orientation == 4,
         )
+        return maxy
 
-    def drawBlock(self, canvas, bx, by, bz, start):
-        return self.drawBlockAt(canvas, bx, by, bz, bx, by, bz, start, 3)
+    def cullHidden(self, node_ids, orientation, covering):
+        """Drop nodes whose top and both front sides are covered by opaque nodes drawn after them
+        (in the spirit of src/primitives/exposed.c). node_ids are in drawing order, covering holds
+        the blocks drawn after this one next to its +y, +z and +x sides (in drawing order, see
+        DRAWING_NEIGHBOURS), or None where nothing is drawn, in which case those sides stay exposed."""
+        opaque = self.opaque[node_ids]
+        hidden = numpy.ones(opaque.shape, dtype=bool)
+        for axis, block in enumerate(covering):
+            inside = [slice(None)] * 3
+            behind = [slice(None)] * 3
+            inside[axis] = slice(None, -1)
+            behind[axis] = slice(1, None)
+            next_opaque = numpy.zeros(opaque.shape, dtype=bool)
+            next_opaque[tuple(inside)] = opaque[tuple(behind)]
+            if block is not None and not block.is_empty and block.generated:
+                last = [slice(None)] * 3
+                first = [slice(None)] * 3
+                last[axis] = -1
+                first[axis] = 0
+                neighbour_ids = orientNodes(self.spriteNodes(block), orientation)[tuple(first)]
+                next_opaque[tuple(last)] = self.opaque[neighbour_ids]
+            hidden &= next_opaque
+        self.culled_nodes += int(numpy.count_nonzero(hidden & (node_ids != INVISIBLE_NODE_ID)))
+        return numpy.where(hidden, INVISIBLE_NODE_ID, node_ids)
 
-    def drawBlockAt(self, canvas, bx, by, bz, dx, dy, dz, start, orientation):
-        """ returns max y of visible node """
-        map_block = self.map.getBlock(bx, by, bz)
-        maxy = -1
-        for y in range(NODES_PER_BLOCK):
-            for z in range(NODES_PER_BLOCK):
-                for x in range(NODES_PER_BLOCK):
-                    node_name = ""
-                    if orientation == 1:
-                        node_name = map_block.get((NODES_PER_BLOCK-x-1), y, (NODES_PER_BLOCK-z-1))
-                    elif orientation == 2:
-                        node_name = map_block.get(x, y, (NODES_PER_BLOCK-z-1))
-                    elif orientation == 4:
-                        node_name = map_block.get((NODES_PER_BLOCK-x-1), y, z)
-                    else:
-                        node_name = map_block.get(x, y, z)
-                    if node_name in node_definitions.INVISIBLE_NODES:
-                        continue
-                    node_image = (
-                        self.node_images[node_name]
-                        if node_name in self.node_images
-                        else self.node_images[b"UNKNOWN_NODE"]
-                    )
-
-
-
-                    if not (node_name in self.node_images):
-                        print(node_name)
-                    elif node_name == b"UNKNOWN_NODE":
-                        print(node_name)
-
-
-
-                    mask = (
-                        self.masks[node_name]
-                        if node_name in self.masks
-                        else None
-                    )
-                    if orientation == 2 or orientation == 4:
-                        self.drawNode(
-                            canvas,
-                            z + dx * NODES_PER_BLOCK,
-                            y + dy * NODES_PER_BLOCK,
-                            x + dz * NODES_PER_BLOCK,
-                            node_image,
-                            start,
-                            mask
-                        )
-                    else:
-                        self.drawNode(
-                            canvas,
-                            x + dx * NODES_PER_BLOCK,
-                            y + dy * NODES_PER_BLOCK,
-                            z + dz * NODES_PER_BLOCK,
-                            node_image,
-                            start,
-                            mask
-                        )
-                    maxy = max(maxy, y + dy * NODES_PER_BLOCK)
-        return maxy
+    @staticmethod
+    def coveringBlocks(blocks, bx, by, bz, orientation):
+        """The neighbours of a block that cullHidden looks at, out of the blocks that will be drawn"""
+        return tuple(
+            blocks.get((bx + ox, by + oy, bz + oz))
+            for ox, oy, oz in DRAWING_NEIGHBOURS[orientation]
+        )
 
-    def makeChunk(self, cx, cz):
+    def makeChunk(self, cx, cz, column=None):
+        """Draw a column of blocks. The Chunk only spans the rows of the BLOCK_SIZE x CHUNK_HEIGHT
+        chunk that the blocks with anything to draw can reach, block by drawing into rows
+        BLOCK_SIZE // 2 * (7 - by) to BLOCK_SIZE // 2 * (9 - by)."""
         maxy = -1
-        canvas = Image.new("RGBA", (BLOCK_SIZE, CHUNK_HEIGHT))
-        for by in range(-8, 8):
+        if column is None:
+            column = self.map.getColumn(cx, cz, range(-8, 8))
+        drawn = [by for by, map_block in zip(range(-8, 8), column) if not map_block.is_empty and map_block.generated]
+        if not drawn:
+            return Chunk(None, (0, 0), maxy)
+        top = BLOCK_SIZE // 2 * (7 - drawn[-1])
+        canvas = Image.new("RGBA", (BLOCK_SIZE, BLOCK_SIZE // 2 * (9 - drawn[0]) - top))
+        for by, map_block in zip(range(-8, 8), column):
+            # the neighbouring columns are drawn into other chunk images, only the block above covers this one
+            above = column[by + 9] if by < 7 else None
             maxy = max(
                 maxy,
                 self.drawBlock(
@@ -145,102 +233,112 @@ class Mapper:
                     cz,
                     (
                         BLOCK_SIZE // 2 * (cx - cz + 1) - NODE_SIZE // 2,
-                        BLOCK_SIZE // 4 * (BLOCKS_PER_CHUNK - cz - cx) - NODE_SIZE // 2,
+                        BLOCK_SIZE // 4 * (BLOCKS_PER_CHUNK - cz - cx) - NODE_SIZE // 2 - top,
                     ),
+                    map_block,
+                    (above, None, None),
                 ),
             )
-        return canvas, maxy
+        return Chunk(canvas, (0, top), maxy)
 
     def fullMap(self):
-         canvas = Image.new("RGBA", (5000, 5000))
-         start = (3000, 3000)
+         left, top, right, bottom = drawingExtent(range(-5, 5), range(-1, 10), range(-5, 5))
+         canvas = Image.new("RGBA", (right - left, bottom - top))
+         start = (-left, -top)
+         blocks = self.map.getBlocks([(x, y, z) for y in range(-1, 10) for z in range(-5, 5) for x in range(-5, 5)])
          for y in range(-1, 10):
              print(y)
              for z in range(-5, 5):
                  for x in range(-5, 5):
-                     self.drawBlock(canvas, x, y, z, start)
+                     self.drawBlock(canvas, x, y, z, start, blocks[(x, y, z)], self.coveringBlocks(blocks, x, y, z, 3))
          canvas.save("map.png")
 
     # orientation can be 1-4
     def mapAtXYWorldPlot(self, xy_x, xy_y, orientation):
+        return self.mapAtXYWorldPlots(xy_x, xy_y, [orientation])[0]
+
+    def mapAtXYWorldPlots(self, xy_x, xy_y, orientations):
+        """Draw a plot in each of orientations (1-4), returns the files written.
+        The blocks are fetched and turned into sprite slots once for all of them,
+        every orientation just draws them flipped (see orientNodes)"""
         print("mapping x=%d and y=%d" % (xy_x, xy_y))
         cx = xToBlockCoordinate(xy_x)
         cz = yToBlockCoordinate(xy_y)
-        canvas = Image.new("RGBA", (5000, 5000))
-        # center the image in the canvas (based on calculcations from makeChunk)
-        start = ((2500 + (BLOCK_SIZE * 3)) + (BLOCK_SIZE // 2 * (cx - cz + 1) - NODE_SIZE // 2),
-                 850 + (BLOCK_SIZE // 4 * (BLOCKS_PER_CHUNK - cz - cx) - NODE_SIZE // 2))
-        for y in range(-2, 10):
-            print("Mapping y=%d" % y)
-            for z in range(8):
-                for x in range(8):
-                    # rotate the map based on orientation
-                    if orientation == 1:
-                        self.drawBlockAt(canvas, cx+(7-x), y, cz-z, cx+x, y, cz-(7-z), start, orientation)
-                    elif orientation == 2:
-                        self.drawBlockAt(canvas, cx+z, y, cz-x, cx+x, y, cz-(7-z), start, orientation)
-                    elif orientation == 3:
-                        self.drawBlockAt(canvas, cx+x, y, cz-(7-z), cx+x, y, cz-(7-z), start, orientation)
-                    else:
-                        self.drawBlockAt(canvas, cx+(7-z), y, cz-(7-x), cx+x, y, cz-(7-z), start, orientation)        
-        """ another way to write the code, kept here in case it helps with clarity
-        for y in range(-2, 10):
-            print("Mapping y=%d" % y)
-            reverse_z = cz - 7
-            xprime = cx + 7
-            reverse_xprime = cx
-            for z in range(cz, cz-8, -1):
-                reverse_x = cx
-                zprime = cz
-                reverse_zprime = cz - 7
-                for x in range(cx+7, cx-1, -1):
-                    if orientation == 1:
-                        self.drawBlockAt(canvas, x, y, z, reverse_x, y, reverse_z, start, orientation)
-                    elif orientation == 2:
-                        self.drawBlockAt(canvas, reverse_xprime, y, zprime, reverse_x, y, reverse_z, start, orientation)
-                    elif orientation == 3:
-                        self.drawBlockAt(canvas, reverse_x, y, reverse_z, reverse_x, y, reverse_z, start, orientation)
-                    else:
-                        self.drawBlockAt(canvas, xprime, y, reverse_zprime, reverse_x, y, reverse_z, start, orientation)
-                    reverse_x = reverse_x + 1
-                    zprime = zprime - 1
-                    reverse_zprime = reverse_zprime + 1
-                reverse_z = reverse_z + 1
-                xprime = xprime - 1
-                reverse_xprime = reverse_xprime + 1
-        """
-        canvas.save("mapxy-%d-%d-%d.png" % (xy_x, xy_y, orientation))
+        # just large enough for the blocks at their drawing positions below
+        left, top, right, bottom = drawingExtent(range(cx, cx + 8), range(-2, 10), range(cz - 7, cz + 1))
+        start = (-left, -top)
+        # the plot is 8x8 blocks whatever the orientation, so fetch them all at once
+        blocks = self.map.getBlocks([(cx + x, y, cz - z) for y in range(-2, 10) for z in range(8) for x in range(8)])
+        filenames = []
+        self.sprite_nodes = {}
+        try:
+            for orientation in orientations:
+                canvas = Image.new("RGBA", (right - left, bottom - top))
+                for y in range(-2, 10):
+                    print("Mapping y=%d" % y)
+                    for z in range(8):
+                        for x in range(8):
+                            # rotate the map based on orientation
+                            if orientation == 1:
+                                bx, bz = cx+(7-x), cz-z
+                            elif orientation == 2:
+                                bx, bz = cx+z, cz-x
+                            elif orientation == 3:
+                                bx, bz = cx+x, cz-(7-z)
+                            else:
+                                bx, bz = cx+(7-z), cz-(7-x)
+                            self.drawBlockAt(
+                                canvas, bx, y, bz, cx+x, y, cz-(7-z), start, orientation,
+                                blocks[(bx, y, bz)], self.coveringBlocks(blocks, bx, y, bz, orientation),
+                            )
+                filename = plotFilename(xy_x, xy_y, orientation)
+                canvas.save(filename)
+                filenames.append(filename)
+        finally:
+            self.sprite_nodes = None
+        return filenames
 
     def mapPieceCenteredAtBlock(self, cx, cz):
-        canvas = Image.new("RGBA", (5000, 5000))
-        # center the image in the canvas (based on calculcations from makeChunk)
-        start = ((2500 - (BLOCK_SIZE // 2)) + (BLOCK_SIZE // 2 * (cx - cz + 1) - NODE_SIZE // 2),
-                 1250 + (BLOCK_SIZE // 4 * (BLOCKS_PER_CHUNK - cz - cx) - NODE_SIZE // 2))
+        left, top, right, bottom = drawingExtent(range(cx - 5, cx + 5), range(-3, 10), range(cz - 5, cz + 5))
+        canvas = Image.new("RGBA", (right - left, bottom - top))
+        start = (-left, -top)
+        blocks = self.map.getBlocks([(x, y, z) for y in range(-3, 10) for z in range(cz-5, cz+5) for x in range(cx-5, cx+5)])
         for y in range(-3, 10):
             print("Mapping y=%d" % y)
             for z in range(cz-5, cz+5):
                 for x in range(cx-5, cx+5):
-                    self.drawBlock(canvas, x, y, z, start)
+                    self.drawBlock(canvas, x, y, z, start, blocks[(x, y, z)], self.coveringBlocks(blocks, x, y, z, 3))
         canvas.save("mapPiece.png")
 
+    def getChunk(self, cx, cz):
+        """makeChunk through the chunk cache"""
+        column = self.map.getColumn(cx, cz, range(-8, 8))
+        key = (cx, cz, tuple(block.timestamp for block in column))
+        chunk = self.chunk_cache.get(key)
+        if chunk is None:
+            chunk = self.makeChunk(cx, cz, column)
+            self.chunk_cache.put(key, chunk)
+        return chunk
+
+    def pasteChunk(self, canvas, cx, cz, position):
+        """Draw the chunk at (cx, cz) onto canvas with its corner at position, returns its maxy"""
+        chunk = self.getChunk(cx, cz)
+        if chunk.image is not None:
+            canvas.paste(chunk.image, (position[0] + chunk.offset[0], position[1] + chunk.offset[1]), chunk.image)
+        return chunk.maxy
+
     def chunks3(self, canvas, x, z, step):
         maxy = -1
-        chunk, y = self.makeChunk(x, z)
+        y = self.pasteChunk(canvas, x, z, (0, step * BLOCK_SIZE // 2))
         maxy = max(maxy, y)
-        canvas.paste(chunk, (0, step * BLOCK_SIZE // 2), chunk)
-        del chunk
-        chunk, y = self.makeChunk(x + 1, z)
-        maxy = max(maxy, y)
-        canvas.paste(
-            chunk, (-BLOCK_SIZE // 2, step * BLOCK_SIZE // 2 + BLOCK_SIZE // 4), chunk
+        y = self.pasteChunk(
+            canvas, x + 1, z, (-BLOCK_SIZE // 2, step * BLOCK_SIZE // 2 + BLOCK_SIZE // 4)
         )
-        del chunk
-        chunk, y = self.makeChunk(x, z + 1)
         maxy = max(maxy, y)
-        canvas.paste(
-            chunk, (BLOCK_SIZE // 2, step * BLOCK_SIZE // 2 + BLOCK_SIZE // 4), chunk
+        y = self.pasteChunk(
+            canvas, x, z + 1, (BLOCK_SIZE // 2, step * BLOCK_SIZE // 2 + BLOCK_SIZE // 4)
         )
-        del chunk
+        maxy = max(maxy, y)
         return maxy
 
     # row = x + z
@@ -258,28 +356,23 @@ class Mapper:
         return tile
     """
 
-    @staticmethod
-    def saveTile(tile, row, col, zoom=5):
-        path = os.path.join("data", str(zoom), str(row))
-        if not os.path.exists(path):
-            os.makedirs(path)
-        tile.save(os.path.join(path, "%d.png" % col))
-
     # assume it's safe to start with (x, z)
     def stupidMakeTiles(self, x, z):
-        # TODO:                                  v
-        canvas = Image.new("RGBA", (BLOCK_SIZE, 100 * BLOCK_SIZE))
+        # the canvas only holds the rows from the top of the next tile down, the
+        # strip above it is done
+        canvas = Image.new("RGBA", (BLOCK_SIZE, STRIP_WINDOW))
         step = 0
         last = 0
         while True:
             # print("tiling %d %d" % (x + step, z + step))
             row, col = coordsToGrid(x + step, z + step)
-            y = self.chunks3(canvas, x + step, z + step, step)
+            y = self.chunks3(canvas, x + step, z + step, step - last // (BLOCK_SIZE // 2))
             # canvas.save("step_{}.png".format(step))
             if row % 4 == 0:
-                tile = canvas.crop((0, last, BLOCK_SIZE, last + BLOCK_SIZE))
+                tile = canvas.crop((0, 0, BLOCK_SIZE, BLOCK_SIZE))
                 last += BLOCK_SIZE
-                self.saveTile(tile, row // 4, col // 2)
+                canvas = canvas.crop((0, BLOCK_SIZE, BLOCK_SIZE, BLOCK_SIZE + STRIP_WINDOW))
+                self.pyramid.saveTile(tile, row // 4, col // 2)
                 del tile
                 self.cnt += 1
             self.available_tiles.add((x + step, z + step))
@@ -287,6 +380,27 @@ class Mapper:
             # print("y is %d" % y)
             if y == -1:
                 break
+        self.strips.append((x, z, step))
+        return step
+
+    def makeTile(self, x, z, step):
+        """Render just the tile stupidMakeTiles(x, z) saves at step, from the steps
+        whose chunks reach into it. Also returns the maxy of chunks3 for each of these
+        steps, starting at max(0, step - STRIP_TILE_REACH)."""
+        first = max(0, step - STRIP_TILE_REACH)
+        top = (step - first) * BLOCK_SIZE // 2
+        canvas = Image.new("RGBA", (BLOCK_SIZE, top + BLOCK_SIZE))
+        maxys = [self.chunks3(canvas, x + s, z + s, s - first) for s in range(first, step + 1)]
+        tile = canvas.crop((0, top, BLOCK_SIZE, top + BLOCK_SIZE))
+        del canvas
+        return tile, maxys
+
+    def joinStrips(self, col, strips):
+        """Join the zoom 4 column col from the tiles of strips, which must all lie in it,
+        while they are still in the tile cache. Returns the rows joined."""
+        rows = {row // 2 for x, z, steps in strips for _, row, _ in stripTiles(x, z, steps)}
+        self.pyramid.joinColumn(BASE_ZOOM - 1, col, rows)
+        return rows
 
     def get_available_tiles(self):
         return self.available_tiles
@@ -294,6 +408,381 @@ class Mapper:
     def get_cnt(self):
         return self.cnt
 
+    def summary(self):
+        lines = ["drew %d blocks, skipped %d empty, missing or ungenerated blocks" % (
+            self.drawn_blocks,
+            self.skipped_blocks,
+        ), "drew %d nodes, culled %d hidden nodes" % (self.drawn_nodes, self.culled_nodes), self.sprites.summary()]
+        for node_name, count in self.unknown_nodes.most_common():
+            lines.append("unknown node %s: %d nodes drawn as UNKNOWN_NODE" % (node_name.decode("ascii", "replace"), count))
+        return "\n".join(lines)
+
+
+# the mapper running in a worker process, see init_worker
+worker_mapper = None
+
+
+def init_worker(map_folder, cache_bytes, tile_cache_bytes, chunk_cache_bytes, chunk_spill_dir):
+    """Every worker process opens its own sqlite connection and has its own sprites, starting from those kept on disk"""
+    global worker_mapper
+    map = Map(map_folder, cache_bytes, invisible=loadRegistry().invisible)
+    worker_mapper = Mapper(map, tile_cache_bytes, chunk_cache_bytes, chunk_spill_dir)
+
+
+def render_strips(coords):
+    """Render the tile strips starting at coords, which all lie on the diagonals of
+    one zoom 4 column, in a worker process, and join that column while its tiles are
+    still in memory. Returns the counters of the work done, the strips and the
+    column joined with its rows."""
+    mapper = worker_mapper
+    for coord in coords:
+        if coord in mapper.get_available_tiles():
+            continue
+        mapper.stupidMakeTiles(*coord)
+    # strips never leave their diagonal, so nothing here is needed for the next ones
+    mapper.available_tiles = set()
+    strips, mapper.strips = mapper.strips, []
+    x, z = coords[0]
+    col = (z - x) // 4
+    rows = mapper.joinStrips(col, strips)
+    # worker processes don't get to run atexit handlers
+    mapper.sprites.save()
+    return mapper.takeStats(), mapper.map.cache.takeStats(), mapper.pyramid.takeStats(), strips, col, rows
+
+
+def render_base_tiles(mapper, coords):
+    """Render the strips starting at coords, in order, and join every zoom 4 column
+    (and the levels above it, see PyramidSchedule) as soon as the loop is past its
+    last coord, so its tiles are more likely to still be in the tile cache"""
+    # strips never leave their diagonal, so a zoom 4 column is done after its last coord
+    last = {}
+    for i, (x, z) in enumerate(coords):
+        last[(z - x) // 4] = i
+    schedule = PyramidSchedule(last, BASE_ZOOM - 1)
+    strips = {}
+    time_last_message = time.perf_counter()
+    last_available_tiles = set()
+    for i, (x, z) in enumerate(coords):
+        finished_tiles = mapper.get_available_tiles()
+        if (x, z) not in finished_tiles:
+            time_current = time.perf_counter()
+            if time_current - time_last_message > 1.0:
+                print(
+                    f"{100.0 * mapper.get_cnt() / len(coords):.2f}% done, added tiles: {finished_tiles - last_available_tiles}"
+                )
+                last_available_tiles = finished_tiles.copy()
+                time_last_message = time_current
+            mapper.stupidMakeTiles(x, z)
+            strips.setdefault((z - x) // 4, []).append(mapper.strips[-1])
+        col = (z - x) // 4
+        if last[col] != i:
+            continue
+        ready = schedule.complete(BASE_ZOOM - 1, col, mapper.joinStrips(col, strips.pop(col, [])))
+        while ready is not None:
+            mapper.pyramid.joinColumn(*ready)
+            ready = schedule.complete(*ready)
+
+
+def join_column(zoom, col, rows):
+    """Join the tiles at rows of a column of zoom in a worker process"""
+    pyramid = worker_mapper.pyramid
+    pyramid.joinColumn(zoom, col, rows)
+    return zoom, col, rows, pyramid.takeStats()
+
+
+def render_base_tiles_parallel(mapper, coords, args, chunk_spill_dir=None):
+    """Same tiles as render_base_tiles, with the diagonals spread over args.jobs processes.
+    A strip only ever covers its own diagonal (z - x is constant), so rendering every
+    diagonal on its own, in the same order, gives the same tiles as the serial loop.
+    The two diagonals of a zoom 4 column go to the same process, they draw the chunks
+    of the diagonal between them both, which the chunk cache can then reuse.
+    Every process joins the zoom 4 column it rendered from the tiles still in its
+    memory, the levels above are joined by the same processes, every column as soon
+    as the columns below it are done, so that overlaps with rendering too."""
+    groups = {}
+    for x, z in coords:
+        groups.setdefault((z - x) // 4, []).append((x, z))
+    # the zoom 4 columns with the most tiles first, so a big one doesn't end up alone at the end
+    work = sorted(groups.values(), key=len, reverse=True)
+    schedule = PyramidSchedule(groups, BASE_ZOOM - 1)
+    results = queue.Queue()
+
+    def submit(func, args):
+        pool.apply_async(
+            func,
+            args,
+            callback=lambda result: results.put((func, result)),
+            error_callback=lambda error: results.put((None, error)),
+        )
+
+    time_last_message = time.perf_counter()
+    done = 0
+    queued = 0
+    outstanding = 0
+    with multiprocessing.Pool(
+        args.jobs,
+        initializer=init_worker,
+        initargs=(
+            args.map_folder,
+            args.block_cache_mb * 1024 * 1024,
+            args.tile_cache_mb * 1024 * 1024,
+            args.chunk_cache_mb * 1024 * 1024,
+            chunk_spill_dir,
+        ),
+    ) as pool:
+        while done < len(work) or outstanding:
+            # only keep a few diagonals queued, so joins that become ready don't wait for all of them
+            while done + queued < len(work) and queued < 2 * args.jobs:
+                submit(render_strips, (work[done + queued],))
+                queued += 1
+                outstanding += 1
+            func, result = results.get()
+            outstanding -= 1
+            if func is None:
+                raise result
+            if func is render_strips:
+                stats, cache_stats, pyramid_stats, strips, col, rows = result
+                mapper.addStats(stats)
+                mapper.map.cache.addStats(cache_stats)
+                mapper.pyramid.addStats(pyramid_stats)
+                mapper.strips.extend(strips)
+                ready = schedule.complete(BASE_ZOOM - 1, col, rows)
+                queued -= 1
+                done += 1
+            else:
+                zoom, col, rows, pyramid_stats = result
+                mapper.pyramid.addStats(pyramid_stats)
+                ready = schedule.complete(zoom, col, rows)
+            if ready is not None:
+                submit(join_column, ready)
+                outstanding += 1
+            time_current = time.perf_counter()
+            if time_current - time_last_message > 1.0:
+                print(f"{100.0 * done / len(work):.2f}% of columns done, {mapper.get_cnt()} tiles")
+                time_last_message = time_current
+
+
+def render_changed_strips(task, mapper=None):
+    """Bring the strips of some diagonals up to date with the changed columns next to them,
+    in a worker process unless a mapper is passed. task is (starts, strips, changed_columns):
+    the starts of render_base_tiles on those diagonals, the strips recorded for them as a
+    dict of (x, z) -> steps, and the changed columns of those diagonals and the ones next
+    to them. Returns the starts of the strips that are gone, the (x, z) -> steps of those
+    that are new or changed, the zoom 5 tiles that were rendered or removed, and the
+    counters of the work done."""
+    mapper = mapper or worker_mapper
+    starts, old_strips, changed_columns = task
+    strips = dict(old_strips)
+    touched = set()
+
+    for (x, z), steps in sorted(old_strips.items()):
+        old_tiles = {(row, col) for _, row, col in stripTiles(x, z, steps)}
+        if (x, z) not in starts:
+            # a fresh render wouldn't start here any more, whatever is left of the
+            # strip is picked up by the other starts below
+            for row, col in old_tiles:
+                mapper.pyramid.removeTile(row, col)
+            touched |= old_tiles
+            del strips[(x, z)]
+            continue
+        changed_steps = [s for s in range(steps) if not changed_columns.isdisjoint(stripColumns(x, z, s))]
+        if not changed_steps:
+            continue
+        # the strip stops at the first step with nothing to draw, if that one
+        # changed the strip may go on further now
+        redo = changed_steps[-1] == steps - 1
+        tiles = []
+        for step, row, col in stripTiles(x, z, steps):
+            if redo:
+                break
+            if not any(s <= step <= s + STRIP_TILE_REACH for s in changed_steps):
+                continue
+            tile, maxys = mapper.makeTile(x, z, step)
+            first = max(0, step - STRIP_TILE_REACH)
+            # ... or a changed step now has nothing to draw, so the strip ends there
+            redo = any(y == -1 for s, y in enumerate(maxys, first) if s < steps - 1)
+            tiles.append((tile, row, col))
+        if redo:
+            new_steps = mapper.stupidMakeTiles(x, z)
+            new_tiles = {(row, col) for _, row, col in stripTiles(x, z, new_steps)}
+            for row, col in old_tiles - new_tiles:
+                mapper.pyramid.removeTile(row, col)
+            touched |= old_tiles | new_tiles
+            strips[(x, z)] = new_steps
+            continue
+        for tile, row, col in tiles:
+            mapper.pyramid.saveTile(tile, row, col)
+            mapper.cnt += 1
+            touched.add((row, col))
+
+    # replay the serial loop over the starts, to render strips for the new ones and
+    # to forget those that a longer or new strip now runs through
+    mapper.available_tiles = set()
+    for x, z in sorted(set(starts) | set(strips)):
+        if (x, z) in mapper.available_tiles:
+            strips.pop((x, z), None)
+            continue
+        if (x, z) in strips:
+            mapper.available_tiles.update((x + s, z + s) for s in range(strips[(x, z)]))
+            continue
+        steps = mapper.stupidMakeTiles(x, z)
+        touched.update((row, col) for _, row, col in stripTiles(x, z, steps))
+        strips[(x, z)] = steps
+    mapper.available_tiles = set()
+    mapper.strips = []
+    # worker processes don't get to run atexit handlers
+    mapper.sprites.save()
+    removed = [start for start in old_strips if start not in strips]
+    updated = {start: steps for start, steps in strips.items() if old_strips.get(start) != steps}
+    return removed, updated, touched, mapper.takeStats(), mapper.map.cache.takeStats()
+
+
+def render_base_tiles_incremental(mapper, coords, state, changed, args, chunk_spill_dir=None):
+    """Bring the base tiles recorded in state up to date with the changed blocks
+    (see RenderState.changedBlocks), leaving every tile not drawn from them alone.
+    Gives the same tiles as render_base_tiles on the whole map. Strips only ever
+    depend on the strips of their own diagonal, so the diagonals next to changed
+    columns are spread over args.jobs processes per zoom 4 column, as in
+    render_base_tiles_parallel. Returns the set of zoom 5 tiles that were rendered
+    or removed."""
+    changed_columns = {}
+    for pos in changed:
+        x, y, z = getIntegerAsBlock(pos)
+        changed_columns.setdefault(z - x, set()).add((x, z))
+    # the columns of a strip are on its own diagonal and the two next to it
+    diagonals = {diagonal + d for diagonal in changed_columns for d in (-1, 0, 1)}
+    groups = {}
+    for x, z in coords:
+        if z - x in diagonals:
+            groups.setdefault((z - x) // 4, (set(), {}, set()))[0].add((x, z))
+    for x, z, steps in state.getStrips():
+        if z - x in diagonals:
+            groups.setdefault((z - x) // 4, (set(), {}, set()))[1][(x, z)] = steps
+    for diagonal in diagonals:
+        if diagonal // 4 in groups:
+            for d in (-1, 0, 1):
+                groups[diagonal // 4][2].update(changed_columns.get(diagonal + d, ()))
+    # the zoom 4 columns with the most strips first, so a big one doesn't end up alone at the end
+    work = sorted(groups.values(), key=lambda task: len(task[0]) + len(task[1]), reverse=True)
+
+    if args.jobs > 1:
+        pool = multiprocessing.Pool(
+            args.jobs,
+            initializer=init_worker,
+            initargs=(args.map_folder, args.block_cache_mb * 1024 * 1024, 0, args.chunk_cache_mb * 1024 * 1024, chunk_spill_dir),
+        )
+        results = pool.imap_unordered(render_changed_strips, work)
+    else:
+        pool = None
+        results = (render_changed_strips(task, mapper) for task in work)
+    touched = set()
+    done = 0
+    time_last_message = time.perf_counter()
+    for removed, updated, tiles, stats, cache_stats in results:
+        for x, z in removed:
+            state.removeStrip(x, z)
+        for (x, z), steps in updated.items():
+            state.setStrip(x, z, steps)
+        touched |= tiles
+        mapper.addStats(stats)
+        mapper.map.cache.addStats(cache_stats)
+        done += 1
+        time_current = time.perf_counter()
+        if time_current - time_last_message > 1.0:
+            print(f"{100.0 * done / len(work):.2f}% of changed columns done, {mapper.get_cnt()} tiles")
+            time_last_message = time_current
+    if pool is not None:
+        pool.close()
+        pool.join()
+    return touched
+
+
+def render_plot(plot, mapper=None):
+    """Render a plot, given as (x, y, orientations), in a worker process unless a mapper
+    is passed. Returns the manifest entry and the counters of the work done."""
+    mapper = mapper or worker_mapper
+    x, y, orientations = plot
+    time_start = time.perf_counter()
+    filenames = mapper.mapAtXYWorldPlots(x, y, orientations)
+    entry = {
+        "x": x,
+        "y": y,
+        "orientations": list(orientations),
+        "files": filenames,
+        "seconds": round(time.perf_counter() - time_start, 3),
+    }
+    # worker processes don't get to run atexit handlers
+    mapper.sprites.save()
+    return entry, mapper.takeStats(), mapper.map.cache.takeStats()
+
+
+def render_plots(mapper, plots, args, index=None):
+    """Render every plot in every orientation of args.orientations, with args.jobs
+    processes, and write the manifest with what was rendered and how long it took.
+    With a PlotIndex, orientations of plots whose footprint didn't change since they
+    were last rendered are skipped."""
+    # the orientations of a plot draw the same blocks, so they stay in one process with
+    # one block cache, the footprints of different plots don't overlap
+    work = [(x, y, args.orientations) for x, y in plots]
+    if index is not None:
+        # hash before rendering, so blocks changing during the render are picked up next time
+        positions = footprintPositions(plots)
+        block_hashes = index.blockHashes(positions, mapper.map.getBlockStamps(positions), mapper.map.getBlockHashes)
+        hashes = footprintHashes(block_hashes, plots)
+        work = [
+            (x, y, [
+                orientation for orientation in orientations
+                if index.getHash(x, y, orientation) != hashes[(x, y)]
+                or not os.path.exists(plotFilename(x, y, orientation))
+            ])
+            for x, y, orientations in work
+        ]
+        work = [plot for plot in work if plot[2]]
+        print(f"{len(plots) - len(work)} of {len(plots)} plots unchanged, skipped")
+    manifest = []
+    time_last_message = time.perf_counter()
+    if args.jobs > 1:
+        pool = multiprocessing.Pool(
+            args.jobs,
+            initializer=init_worker,
+            initargs=(args.map_folder, args.block_cache_mb * 1024 * 1024, 0, 0, None),
+        )
+        results = pool.imap_unordered(render_plot, work)
+    else:
+        pool = None
+        results = (render_plot(plot, mapper) for plot in work)
+    for entry, stats, cache_stats in results:
+        manifest.append(entry)
+        mapper.addStats(stats)
+        mapper.map.cache.addStats(cache_stats)
+        if index is not None:
+            for orientation in entry["orientations"]:
+                index.setHash(entry["x"], entry["y"], orientation, hashes[(entry["x"], entry["y"])])
+        time_current = time.perf_counter()
+        if time_current - time_last_message > 1.0:
+            print(f"{100.0 * len(manifest) / len(work):.2f}% of plots done")
+            time_last_message = time_current
+    if pool is not None:
+        pool.close()
+        pool.join()
+    if index is not None:
+        index.commit()
+    manifest.sort(key=lambda entry: (entry["y"], entry["x"]))
+    with open(args.manifest, "w") as f:
+        json.dump(manifest, f, indent=1)
+
+
+def plot_range(spec):
+    """Plot coordinates from "X,Y", where X and Y can also be inclusive ranges like 0-127"""
+    try:
+        xs, ys = (
+            range(int(first), int(last or first) + 1)
+            for first, _, last in (part.partition("-") for part in spec.split(","))
+        )
+    except ValueError:
+        raise argparse.ArgumentTypeError("expected X,Y with X and Y a number or a range like 0-127, got %r" % spec)
+    return [(x, y) for y in ys for x in xs]
+
 
 def parse_arguments():
     parser = argparse.ArgumentParser(
@@ -303,18 +792,124 @@ def parse_arguments():
     parser.add_argument(
         "--map_folder", help="Path to the folder with the map.sqlite file", default="."
     )
+    parser.add_argument(
+        "--block_cache_mb",
+        help="Memory to use for caching decoded map blocks, in MB (0 disables the cache)",
+        type=int,
+        default=DEFAULT_CACHE_BYTES // (1024 * 1024),
+    )
+    parser.add_argument(
+        "--tile_cache_mb",
+        help="Memory to use for keeping rendered tiles around until they are joined into the next zoom level, in MB",
+        type=int,
+        default=DEFAULT_TILE_CACHE_BYTES // (1024 * 1024),
+    )
+    parser.add_argument(
+        "--chunk_cache_mb",
+        help="Memory to use for keeping rendered chunks around for the neighbouring strips, in MB (per process)",
+        type=int,
+        default=DEFAULT_CHUNK_CACHE_BYTES // (1024 * 1024),
+    )
+    parser.add_argument(
+        "--chunk_spill_dir",
+        help="Directory to write chunks that don't fit into --chunk_cache_mb to, instead of dropping them",
+    )
+    parser.add_argument(
+        "--tiles",
+        help="Render the full tile pyramid into data/ instead of the sample plots",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--jobs",
+        help="Number of processes rendering tiles",
+        type=int,
+        default=1,
+    )
+    parser.add_argument(
+        "--plots",
+        help="Render these XY plots instead of the sample plots, each given as X,Y where X and Y "
+        "can also be ranges, e.g. 0-%d,0-%d for all of them" % (MAX_XY_SIZE - 1, MAX_XY_SIZE - 1),
+        type=plot_range,
+        nargs="+",
+    )
+    parser.add_argument(
+        "--orientations",
+        help="Orientations to render every plot of --plots in",
+        type=int,
+        choices=(1, 2, 3, 4),
+        nargs="+",
+        default=[1],
+    )
+    parser.add_argument(
+        "--manifest",
+        help="File to list the plots rendered for --plots in, with the time each took "
+        "(with --incremental, only those that were rendered again)",
+        default="plots.json",
+    )
+    parser.add_argument(
+        "--topdown",
+        help="Render the tile pyramid into %s/ as a flat map seen from above, one colour per node, "
+        "instead of the isometric one into data/ (much faster)" % TOPDOWN_ROOT,
+        action="store_true",
+    )
+    parser.add_argument(
+        "--topdown_scale",
+        help="Pixels per node for --topdown",
+        type=int,
+        choices=TOPDOWN_SCALES,
+        default=1,
+    )
+    parser.add_argument(
+        "--topdown_shading",
+        help="Shade the slopes of the --topdown map by height",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--incremental",
+        help="Only re-render the tiles (or with --plots, the plot images) drawn from blocks that changed "
+        "since the last --incremental run (what was rendered from what is kept in data/render_state.sqlite, "
+        "or plot_index.sqlite for plots)",
+        action="store_true",
+    )
     return parser.parse_args()
 
 
 def main():
     args = parse_arguments()
-    map = Map(args.map_folder)
-    mapper = Mapper(map)
-    
-    # test just print out a sample map
-    mapper.mapAtXYWorldPlot(73, 3, 1)
-    mapper.mapAtXYWorldPlot(31, 82, 1)
-    return;
+    map = Map(args.map_folder, args.block_cache_mb * 1024 * 1024, invisible=loadRegistry().invisible)
+    if args.topdown:
+        topdown_mapper = TopDownMapper(map, args.topdown_scale, args.topdown_shading, args.tile_cache_mb * 1024 * 1024)
+        render_topdown(topdown_mapper, args)
+        print(topdown_mapper.summary())
+        print(topdown_mapper.pyramid.summary())
+        print(map.cache.summary())
+        return
+
+    chunk_spill_dir = None
+    if args.chunk_spill_dir is not None:
+        # spilled chunks are only any good to this run
+        os.makedirs(args.chunk_spill_dir, exist_ok=True)
+        chunk_spill_dir = tempfile.mkdtemp(prefix="chunks-", dir=args.chunk_spill_dir)
+        atexit.register(shutil.rmtree, chunk_spill_dir, True)
+    mapper = Mapper(map, args.tile_cache_mb * 1024 * 1024, args.chunk_cache_mb * 1024 * 1024, chunk_spill_dir)
+    # keep the sprites built for the next runs
+    atexit.register(mapper.sprites.save)
+
+    if args.plots:
+        plots = sorted({plot for plots in args.plots for plot in plots}, key=lambda plot: (plot[1], plot[0]))
+        index = PlotIndex("plot_index.sqlite", texturesKey()) if args.incremental else None
+        render_plots(mapper, plots, args, index)
+        print(mapper.summary())
+        print(map.cache.summary())
+        return
+
+    if not args.tiles:
+        # test just print out a sample map
+        mapper.mapAtXYWorldPlot(73, 3, 1)
+        mapper.mapAtXYWorldPlot(31, 82, 1)
+        print(mapper.summary())
+        print(map.cache.summary())
+        return
 
     raw_coords = list(map.getCoordinatesToDraw())
     coords = []
@@ -324,79 +919,49 @@ def main():
         coords.append(gridToCoords(row, col))
     coords.sort()
 
-    time_last_message = time.perf_counter()
-    last_available_tiles = set()
-    for coord in coords:
-        finished_tiles = mapper.get_available_tiles()
-        if coord in finished_tiles:
-            continue
-        time_current = time.perf_counter()
-        if time_current - time_last_message > 1.0:
-            print(
-                f"{100.0 * mapper.get_cnt() / len(coords):.2f}% done, added tiles: {finished_tiles - last_available_tiles}"
-            )
-            last_available_tiles = finished_tiles.copy()
-            time_last_message = time_current
-        mapper.stupidMakeTiles(*coord)
+    state = None
+    if args.incremental:
+        os.makedirs("data", exist_ok=True)
+        state = RenderState(os.path.join("data", "render_state.sqlite"), texturesKey())
+        # before rendering, so blocks changing during the render are picked up next time
+        changed = state.changedBlocks(map.iterBlockStamps(), map.getBlockHashes)
+
+    if state is not None and not state.isEmpty():
+        touched = render_base_tiles_incremental(mapper, coords, state, changed, args, chunk_spill_dir)
+        print(f"{len(changed)} blocks changed, rendered {mapper.get_cnt()} tiles")
+        mapper.pyramid.build(touched)
+    else:
+        if args.jobs > 1:
+            # joins the zoom levels as well
+            render_base_tiles_parallel(mapper, coords, args, chunk_spill_dir)
+        else:
+            # joins the zoom levels as well
+            render_base_tiles(mapper, coords)
+        if state is not None:
+            for strip in mapper.strips:
+                state.setStrip(*strip)
 
-    """
-    step = 0
-    for row, col in coords:
-        step += 1
-        print("[{}%]".format(100.0 * step / len(coords)))
-        if row % 4 != 0 or col % 2 != 0:
-            continue
-        path = os.path.join("data", "5", "{}".format(row / 4 ))
-        if not os.path.exists(path):
-            os.makedirs(path)
-        dummyMakeTile(row, col).save(os.path.join(path, "{}.png".format(col / 2)))
-    """
-
-    # zoom 4 ---> 0
-
-    to_join = raw_coords
-
-    for zoom in range(4, -1, -1):
-        new_join = set()
-        for row, col in to_join:
-            if zoom == 4:
-                if row % 4 != 0 or col % 2 != 0:
-                    continue
-                row //= 4
-                col //= 2
-            if row % 2 == 1:
-                row -= 1
-            if col % 2 == 1:
-                col -= 1
-            new_join.add((row, col))
-        to_join = new_join
-
-        for row, col in to_join:
-            # print("join {} {}".format(row, col))
-            R = row // 2
-            C = col // 2
-            path = os.path.join("data", str(zoom), str(R))
+        """
+        step = 0
+        for row, col in coords:
+            step += 1
+            print("[{}%]".format(100.0 * step / len(coords)))
+            if row % 4 != 0 or col % 2 != 0:
+                continue
+            path = os.path.join("data", "5", "{}".format(row / 4 ))
             if not os.path.exists(path):
                 os.makedirs(path)
-            canvas = Image.new("RGBA", (BLOCK_SIZE, BLOCK_SIZE))
-            for dx in range(0, 2):
-                for dz in range(0, 2):
-                    try:
-                        tile = Image.open(
-                            os.path.join(
-                                "data",
-                                str(zoom + 1),
-                                str(row + dx),
-                                "%d.png" % (col + dz),
-                            )
-                        ).convert("RGBA")
-                    except IOError:
-                        tile = Image.new("RGBA", (BLOCK_SIZE, BLOCK_SIZE))
-                    tile = tile.resize((BLOCK_SIZE // 2, BLOCK_SIZE // 2))
-                    canvas.paste(
-                        tile, (dz * BLOCK_SIZE // 2, dx * BLOCK_SIZE // 2), tile
-                    )
-            canvas.save(os.path.join(path, "%d.png" % C))
+            dummyMakeTile(row, col).save(os.path.join(path, "{}.png".format(col / 2)))
+        """
+
+    if state is not None:
+        state.updateBlocks(changed)
+        state.commit()
+
+    print(mapper.summary())
+    print(mapper.pyramid.summary())
+    print(mapper.chunk_cache.summary())
+    print(map.cache.summary())
 
 
 if __name__ == "__main__":
@@ -0,0 +1,242 @@
+import hashlib
+import os
+import os.path
+import time
+import threading
+
+import numpy
+from PIL import Image
+
+from blocks import build_block, build_full_block, build_sprite, build_billboard, build_full_transparent_block
+from constants import *
+from util import *
+from registry import loadRegistry
+
+NODE_TABLE_PATH = os.path.join("cache", "node_table.npz")
+ATLAS_PATH = os.path.join("cache", "sprite_atlas.npz")
+
+# bump whenever what goes into the node table or the sprite atlas changes
+NODE_TABLE_VERSION = 2
+
+NODE_TABLE_DTYPE = numpy.dtype([
+    # mean RGBA of the node image, see averageColour
+    ("colour", numpy.uint8, 4),
+    # mean RGBA of the node seen from straight above
+    ("top_colour", numpy.uint8, 4),
+    # hides everything behind its top and front sides, see isOpaque
+    ("opaque", numpy.bool_),
+    # fraction of the pixels of the node image that are not fully transparent
+    ("coverage", numpy.float32),
+])
+
+
+def loadTexture(texture):
+    """A texture of a node (see NodeRegistry.textures) as an RGBA image, None for no texture ("")"""
+    if texture == "":
+        return None
+    return Image.open(os.path.join("textures", texture)).convert("RGBA")
+
+
+def buildNodeImage(top, side, bottom):
+    """The image of a node from its (loaded) textures, the kind of image depends on which are there"""
+    # only bottom texture, means it is a flat block, like lily pads
+    if bottom != None and top == None and side == None:
+        return build_full_block(None, None, None, None, None, bottom)
+    # only side texture, means it is a sprite, like flowers
+    elif side != None and top == None and bottom == None:
+        return build_sprite(side)
+    # only top texture, means it is a billboard block, like reeds
+    elif top != None and side == None and bottom == None:
+        return build_billboard(top)
+    # all textures, means it is a full block but designed to be transparent, like water
+    elif top != None and side != None and bottom != None:
+        # leave out the back sides for now, to make it appear even more transparent
+        return build_full_transparent_block(top, None, None, side, side, bottom)
+    # otherwise, build a regular block
+    return build_block(top, side)
+
+
+def isOpaque(top, side, bottom):
+    """A regular block of opaque textures hides everything behind its top and front sides"""
+    return (
+        top != None and side != None and bottom == None
+        and top.getextrema()[3][0] == 255 and side.getextrema()[3][0] == 255
+    )
+
+
+def averageColour(image):
+    """Mean RGBA of an image, the colour weighted by alpha so transparent pixels don't darken it"""
+    pixels = numpy.asarray(image.convert("RGBA"), dtype=numpy.float64).reshape(-1, 4)
+    alpha = pixels[:, 3]
+    if alpha.sum() == 0:
+        return (0, 0, 0, 0)
+    rgb = (pixels[:, :3] * alpha[:, None]).sum(axis=0) / alpha.sum()
+    return tuple(int(round(v)) for v in rgb) + (int(round(alpha.mean())),)
+
+
+def texturesKey():
+    """Hash of the node definitions and the modification times of their textures"""
+    registry = loadRegistry()
+    digest = hashlib.blake2b(digest_size=16)
+    digest.update(b"%d" % NODE_TABLE_VERSION)
+    digest.update(registry.digest.encode())
+    textures = {texture for node_textures in registry.textures for texture in node_textures if texture != ""}
+    for texture in sorted(textures):
+        digest.update(repr((texture, os.stat(os.path.join("textures", texture)).st_mtime_ns)).encode())
+    return digest.hexdigest()
+
+
+def buildNodeTable():
+    """NODE_TABLE_DTYPE entry of every node, indexed by global node id (see NodeRegistry)"""
+    node_textures_by_id = loadRegistry().textures
+    table = numpy.zeros(len(node_textures_by_id), dtype=NODE_TABLE_DTYPE)
+    entries = {}
+    for node_id, node_textures in enumerate(node_textures_by_id):
+        # many nodes share their textures, and so everything in their entry
+        if node_textures not in entries:
+            top, side, bottom = (loadTexture(texture) for texture in node_textures)
+            image = buildNodeImage(top, side, bottom)
+            # seen from above: the top, or whatever there is of flat blocks and sprites
+            seen = next((texture for texture in (top, bottom, side) if texture is not None), None)
+            alpha = numpy.asarray(image.getchannel("A"))
+            entries[node_textures] = (
+                averageColour(image),
+                averageColour(seen) if seen is not None else (0, 0, 0, 0),
+                isOpaque(top, side, bottom),
+                numpy.count_nonzero(alpha) / alpha.size,
+            )
+        table[node_id] = entries[node_textures]
+    return table
+
+
+def loadCached(path, build):
+    """The array saved at path, or if it was built from other node definitions or
+    textures (see texturesKey) than the current ones, build() it and save it there"""
+    key = texturesKey()
+    try:
+        with numpy.load(path) as cached:
+            if str(cached["key"]) == key:
+                return cached["array"]
+    except (OSError, KeyError, ValueError):
+        pass
+    array = build()
+    # worker processes may be doing the same
+    with replacingFile(path) as f:
+        numpy.savez(f, array=array, key=numpy.array(key))
+    return array
+
+
+def loadNodeTable(path=NODE_TABLE_PATH):
+    """The node table (see buildNodeTable), kept at path"""
+    return loadCached(path, buildNodeTable)
+
+
+class SpriteAtlas(StatCounters):
+    """The node images stacked into one column for draw_block. Nodes with the same
+    textures (top, side, bottom) get the same image, and so share a slot: the image
+    of slot i is at rows NODE_SIZE * i to NODE_SIZE * (i + 1), see slots for the slot
+    of a node id. Images are only built when a slot is first needed (see require),
+    together with whether it is opaque (see isOpaque).
+    What was built is kept at path for the next runs and other processes, keyed like
+    loadCached. With a mask, it replaces the alpha channel of the textures and nothing
+    is kept."""
+    STAT_COUNTERS = ("built_sprites", "build_seconds")
+
+    def __init__(self, path=ATLAS_PATH, mask=None):
+        self.path = path if mask is None else None
+        self.mask = mask
+        # textures of every slot, and the slot of every node id
+        self.slot_textures = []
+        slot_of = {}
+        node_textures_by_id = loadRegistry().textures
+        for node_textures in node_textures_by_id:
+            if node_textures not in slot_of:
+                slot_of[node_textures] = len(self.slot_textures)
+                self.slot_textures.append(node_textures)
+        self.slot_of = numpy.array(
+            [slot_of[node_textures] for node_textures in node_textures_by_id], dtype=numpy.int32
+        )
+        count = len(self.slot_textures)
+        self.image = Image.new("RGBA", (NODE_SIZE, NODE_SIZE * count))
+        self.built = numpy.zeros(count, dtype=bool)
+        # the extra last entry keeps negative slots (never drawn) from being opaque
+        self.opaque = numpy.zeros(count + 1, dtype=bool)
+        self.lock = threading.Lock()
+        self.unsaved = False
+        self.built_sprites = 0
+        self.build_seconds = 0.0
+        self.loaded_sprites = 0
+        if self.path is not None:
+            self.key = texturesKey()
+            cached = self.readCache()
+            if cached is not None:
+                pixels, built, opaque = cached
+                self.image = Image.fromarray(pixels, "RGBA")
+                self.built = built
+                self.opaque = opaque
+                self.loaded_sprites = int(numpy.count_nonzero(built))
+
+    def readCache(self):
+        """(pixels, built, opaque) saved at path, None if there are none for the current key"""
+        try:
+            with numpy.load(self.path) as cached:
+                if str(cached["key"]) == self.key:
+                    return cached["pixels"], cached["built"], cached["opaque"]
+        except (OSError, KeyError, ValueError):
+            pass
+        return None
+
+    def slots(self, node_ids):
+        """The slots of an array of node ids, negative ids (never drawn) stay as they are"""
+        return numpy.where(node_ids >= 0, self.slot_of[node_ids], node_ids)
+
+    def require(self, slots):
+        """Build the images of the slots that weren't built yet, negative slots are never drawn"""
+        missing = [slot for slot in slots if slot >= 0 and not self.built[slot]]
+        if not missing:
+            return
+        with self.lock:
+            time_start = time.perf_counter()
+            for slot in missing:
+                if self.built[slot]:
+                    continue
+                top, side, bottom = (loadTexture(texture) for texture in self.slot_textures[slot])
+                image = buildNodeImage(top, side, bottom)
+                if self.mask is not None:
+                    image.putalpha(self.mask.convert("L"))
+                self.image.paste(image, (0, slot * NODE_SIZE))
+                self.opaque[slot] = isOpaque(top, side, bottom)
+                self.built[slot] = True
+                self.built_sprites += 1
+                self.unsaved = True
+            self.build_seconds += time.perf_counter() - time_start
+
+    def save(self):
+        """Keep what was built at path, along with what other processes kept there meanwhile"""
+        if self.path is None or not self.unsaved:
+            return
+        with self.lock:
+            pixels = numpy.array(self.image)
+            built = self.built.copy()
+            opaque = self.opaque.copy()
+            cached = self.readCache()
+            if cached is not None:
+                # two processes saving at the same time can lose what one of them built,
+                # it just gets built again when it is needed
+                theirs = cached[1] & ~built
+                rows = numpy.repeat(theirs, NODE_SIZE)
+                pixels[rows] = cached[0][rows]
+                built |= theirs
+                opaque[:-1][theirs] = cached[2][:-1][theirs]
+            with replacingFile(self.path) as f:
+                numpy.savez(f, pixels=pixels, built=built, opaque=opaque, key=numpy.array(self.key))
+            self.unsaved = False
+
+    def summary(self):
+        return "sprites: built %d of %d in %.2fs, %d loaded from %s" % (
+            self.built_sprites,
+            len(self.built),
+            self.build_seconds,
+            self.loaded_sprites,
+            self.path or "nowhere (masked)",
+        )
@@ -0,0 +1,192 @@
+import os
+import os.path
+from collections import OrderedDict
+
+from PIL import Image
+
+from onomatopoeia.c_overviewer import resize_half
+from constants import *
+from util import *
+
+# zoom level of the tiles rendered from the map, every level above is joined from the one below
+BASE_ZOOM = 5
+
+TILE_BYTES = BLOCK_SIZE * BLOCK_SIZE * 4
+
+DEFAULT_TILE_CACHE_BYTES = 128 * 1024 * 1024
+
+
+def tilePath(row, col, zoom, root="data"):
+    return os.path.join(root, str(zoom), str(row), "%d.png" % col)
+
+
+def isEmptyTile(tile):
+    return tile.getchannel("A").getbbox() is None
+
+
+class TileCache(StatCounters):
+    """Recently saved tiles, so they don't have to be loaded again to join them into
+    the next zoom level. Every tile is joined once, so taking one out drops it."""
+    STAT_COUNTERS = ("hits",)
+
+    def __init__(self, max_bytes):
+        self.max_tiles = max_bytes // TILE_BYTES
+        self.tiles = OrderedDict()
+        self.hits = 0
+
+    def put(self, key, tile):
+        if self.max_tiles <= 0:
+            return
+        self.tiles[key] = tile
+        self.tiles.move_to_end(key)
+        while len(self.tiles) > self.max_tiles:
+            self.tiles.popitem(last=False)
+
+    def take(self, key):
+        tile = self.tiles.pop(key, None)
+        if tile is not None:
+            self.hits += 1
+        return tile
+
+
+class Pyramid(StatCounters):
+    """Saves the tiles in root (data/ by default) and joins zoom levels BASE_ZOOM - 1
+    to 0 from them. A tile at (row, col) of a level is the four tiles
+    (2 * row + 0..1, 2 * col + 0..1) of the level below, downscaled with resize_half."""
+    STAT_COUNTERS = ("joined", "loaded", "empty_quadrants", "cache")
+
+    def __init__(self, cache_bytes=0, root="data"):
+        self.root = root
+        self.cache = TileCache(cache_bytes)
+        self.joined = 0
+        self.loaded = 0
+        self.empty_quadrants = 0
+
+    def saveTile(self, tile, row, col, zoom=BASE_ZOOM):
+        path = tilePath(row, col, zoom, self.root)
+        # other processes may be creating the directory at the same time
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tile.save(path)
+        self.cache.put((zoom, row, col), tile)
+
+    def removeTile(self, row, col, zoom=BASE_ZOOM):
+        try:
+            os.remove(tilePath(row, col, zoom, self.root))
+        except FileNotFoundError:
+            pass
+
+    def loadTile(self, row, col, zoom):
+        """The saved tile, or None if there is none"""
+        tile = self.cache.take((zoom, row, col))
+        if tile is not None:
+            return tile
+        try:
+            with Image.open(tilePath(row, col, zoom, self.root)) as tile:
+                tile = tile.convert("RGBA")
+        except FileNotFoundError:
+            return None
+        self.loaded += 1
+        return tile
+
+    def joinTile(self, row, col, zoom):
+        """Build the tile at (row, col) of zoom from the level below, None if all of it is empty"""
+        canvas = None
+        for dr in range(2):
+            for dc in range(2):
+                child = self.loadTile(2 * row + dr, 2 * col + dc, zoom + 1)
+                if child is None or isEmptyTile(child):
+                    self.empty_quadrants += 1
+                    continue
+                if canvas is None:
+                    canvas = Image.new("RGBA", (BLOCK_SIZE, BLOCK_SIZE))
+                quadrant = Image.new("RGBA", (BLOCK_SIZE // 2, BLOCK_SIZE // 2))
+                resize_half(quadrant, child)
+                canvas.paste(quadrant, (dc * BLOCK_SIZE // 2, dr * BLOCK_SIZE // 2))
+        return canvas
+
+    def joinColumn(self, zoom, col, rows):
+        """Join and save the tiles at rows of a column of zoom. Tiles that end up
+        empty are removed, they may be left over from an earlier run."""
+        for row in sorted(rows):
+            tile = self.joinTile(row, col, zoom)
+            if tile is None:
+                self.removeTile(row, col, zoom)
+                continue
+            self.saveTile(tile, row, col, zoom)
+            self.joined += 1
+
+    def build(self, base_tiles):
+        """Join every tile above the given (row, col) of the base level, each level once"""
+        tiles = set(base_tiles)
+        for zoom in range(BASE_ZOOM - 1, -1, -1):
+            columns = {}
+            for row, col in tiles:
+                columns.setdefault(col // 2, set()).add(row // 2)
+            for col, rows in sorted(columns.items()):
+                self.joinColumn(zoom, col, rows)
+            tiles = {(row, col) for col, rows in columns.items() for row in rows}
+
+    def summary(self):
+        return "joined %d zoom tiles, skipped %d empty quarters, took %d tiles from memory and loaded %d" % (
+            self.joined,
+            self.empty_quadrants,
+            self.cache.hits,
+            self.loaded,
+        )
+
+
+class PyramidSchedule(object):
+    """Keeps track of the tile columns that are complete, so every column of a zoom
+    level can be joined as soon as the (up to) two columns below it are, instead of
+    waiting for the whole level below. Starts out expecting columns of zoom."""
+    def __init__(self, columns, zoom=BASE_ZOOM):
+        self.expected = {zoom: set(columns)}
+        for zoom in range(zoom - 1, -1, -1):
+            self.expected[zoom] = {col // 2 for col in self.expected[zoom + 1]}
+        # rows of the complete columns that weren't joined into the next level yet
+        self.rows = {zoom: {} for zoom in self.expected}
+
+    def complete(self, zoom, col, rows):
+        """Mark a column of zoom complete, with its tiles at rows saved (or removed).
+        Returns the (zoom, col, rows) that can be joined now, or None."""
+        self.rows[zoom][col] = set(rows)
+        if zoom == 0:
+            return None
+        parent = col // 2
+        children = [c for c in (2 * parent, 2 * parent + 1) if c in self.expected[zoom]]
+        if any(c not in self.rows[zoom] for c in children):
+            return None
+        rows = {row // 2 for c in children for row in self.rows[zoom].pop(c)}
+        return zoom - 1, parent, rows
+
+
+class PyramidRowSchedule(object):
+    """Joins the zoom levels of pyramid while its base tiles are saved a row at a time,
+    the last row first (as topdownTiles yields them): every tile as soon as the rows
+    below it are done, so the tiles it is joined from are likely still in the tile cache."""
+    def __init__(self, pyramid):
+        self.pyramid = pyramid
+        # (row, col) of the tiles of every zoom level that are still to be joined
+        self.pending = {zoom: set() for zoom in range(BASE_ZOOM)}
+
+    def saved(self, row, col):
+        """A base tile was saved at (row, col)"""
+        self.pending[BASE_ZOOM - 1].add((row // 2, col // 2))
+
+    def done(self, row=None):
+        """Every base row after row is done, all of them if row is None. Joins every
+        tile all of whose base rows are done."""
+        for zoom in range(BASE_ZOOM - 1, -1, -1):
+            # a tile covers the base rows from its row << (BASE_ZOOM - zoom) on
+            ready = {
+                (r, c) for r, c in self.pending[zoom]
+                if row is None or r > row >> (BASE_ZOOM - zoom)
+            }
+            self.pending[zoom] -= ready
+            columns = {}
+            for r, c in ready:
+                columns.setdefault(c, set()).add(r)
+            for col, rows in sorted(columns.items()):
+                self.pyramid.joinColumn(zoom, col, rows)
+            if zoom > 0:
+                self.pending[zoom - 1] |= {(r // 2, c // 2) for r, c in ready}
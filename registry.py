@@ -0,0 +1,144 @@
+#!/usr/bin/env python3
+import hashlib
+import os
+import os.path
+import struct
+
+import numpy
+
+from util import *
+
+REGISTRY_PATH = os.path.join("cache", "node_registry.bin")
+DEFINITIONS_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "node_definitions.py")
+
+# change whenever the layout of the file changes
+REGISTRY_MAGIC = b"ONOMREG\x01"
+# magic, number of names, number of drawn nodes, number of textures, bytes of all names, bytes of all textures
+REGISTRY_HEADER = struct.Struct("<8sIIIII")
+
+# id of the invisible nodes, the same as Mapper's INVISIBLE_NODE_ID
+INVISIBLE_ID = -1
+
+
+def compileRegistry(path=REGISTRY_PATH):
+    """Compile node_definitions into the registry file at path. Little-endian, after
+    REGISTRY_HEADER:
+        u32[names + 1]    offsets of the names, sorted, in the name bytes
+        i32[names]        id of every name, INVISIBLE_ID for INVISIBLE_NODES
+        u8[names]         1 for INVISIBLE_NODES
+        i32[nodes][3]     (top, side, bottom) textures of every id, -1 for no texture
+        u32[textures + 1] offsets of the texture file names in the texture bytes
+        name bytes, texture bytes
+    Ids are in the order of NODE_TEXTURES."""
+    import node_definitions
+    ids = {}
+    texture_index = {}
+    node_textures = []
+    for node_id, (node_name, textures) in enumerate(node_definitions.NODE_TEXTURES.items()):
+        ids[node_name.encode("ascii")] = node_id
+        node_textures.append([
+            texture_index.setdefault(texture, len(texture_index)) if texture != "" else -1
+            for texture in textures
+        ])
+    invisible = {
+        node_name.encode("ascii") if isinstance(node_name, str) else node_name
+        for node_name in node_definitions.INVISIBLE_NODES
+    }
+    # their id would be left without a name
+    drawn = sorted(invisible & ids.keys())
+    if drawn:
+        raise ValueError("nodes both in NODE_TEXTURES and INVISIBLE_NODES: %s" % b", ".join(drawn).decode("ascii"))
+    for node_name in invisible:
+        ids[node_name] = INVISIBLE_ID
+    names = sorted(ids)
+    name_bytes = b"".join(names)
+    texture_bytes = [texture.encode("utf-8") for texture in texture_index]
+    data = b"".join([
+        REGISTRY_HEADER.pack(
+            REGISTRY_MAGIC, len(names), len(node_textures), len(texture_bytes),
+            len(name_bytes), sum(len(texture) for texture in texture_bytes),
+        ),
+        numpy.cumsum([0] + [len(name) for name in names], dtype="<u4").tobytes(),
+        numpy.array([ids[name] for name in names], dtype="<i4").tobytes(),
+        numpy.array([ids[name] == INVISIBLE_ID for name in names], dtype="u1").tobytes(),
+        numpy.array(node_textures, dtype="<i4").reshape(-1, 3).tobytes(),
+        numpy.cumsum([0] + [len(texture) for texture in texture_bytes], dtype="<u4").tobytes(),
+        name_bytes,
+        b"".join(texture_bytes),
+    ])
+    # other processes may be loading it at the same time
+    with replacingFile(path) as f:
+        f.write(data)
+    return data
+
+
+class NodeRegistry(object):
+    """node_definitions as loaded from a compiled registry (see compileRegistry):
+    ids maps every node name (bytes) to its global id, or INVISIBLE_ID, invisible
+    holds the names of INVISIBLE_NODES, textures the (top, side, bottom) texture
+    file names of every id ("" for none, as in NODE_TEXTURES) and names the name
+    of every id. digest changes whenever any of it does."""
+    def __init__(self, data):
+        magic, name_count, node_count, texture_count, names_size, textures_size = REGISTRY_HEADER.unpack_from(data)
+        if magic != REGISTRY_MAGIC:
+            raise ValueError("not a node registry of this version")
+        pos = REGISTRY_HEADER.size
+        name_offsets = numpy.frombuffer(data, dtype="<u4", count=name_count + 1, offset=pos).tolist()
+        pos += 4 * (name_count + 1)
+        name_ids = numpy.frombuffer(data, dtype="<i4", count=name_count, offset=pos).tolist()
+        pos += 4 * name_count
+        invisible = numpy.frombuffer(data, dtype="u1", count=name_count, offset=pos).tolist()
+        pos += name_count
+        node_textures = numpy.frombuffer(data, dtype="<i4", count=3 * node_count, offset=pos).reshape(-1, 3).tolist()
+        pos += 12 * node_count
+        texture_offsets = numpy.frombuffer(data, dtype="<u4", count=texture_count + 1, offset=pos).tolist()
+        pos += 4 * (texture_count + 1)
+        name_bytes = data[pos:pos + names_size]
+        pos += names_size
+        texture_bytes = data[pos:pos + textures_size]
+
+        names = [name_bytes[name_offsets[i]:name_offsets[i + 1]] for i in range(name_count)]
+        self.ids = dict(zip(names, name_ids))
+        self.invisible = frozenset(name for name, flag in zip(names, invisible) if flag)
+        self.names = [None] * node_count
+        for name, node_id in self.ids.items():
+            if node_id != INVISIBLE_ID:
+                self.names[node_id] = name
+        texture_names = [""] + [
+            texture_bytes[texture_offsets[i]:texture_offsets[i + 1]].decode("utf-8") for i in range(texture_count)
+        ]
+        # -1 is no texture, which is the "" at the start
+        self.textures = [tuple(texture_names[i + 1] for i in textures) for textures in node_textures]
+        self.digest = hashlib.blake2b(data, digest_size=16).hexdigest()
+
+
+# the registry of this process, see loadRegistry
+registry = None
+
+
+def loadRegistry(path=REGISTRY_PATH):
+    """The NodeRegistry at path, compiled again first if node_definitions.py changed since"""
+    global registry
+    if registry is not None:
+        return registry
+    data = None
+    try:
+        if os.stat(path).st_mtime_ns >= os.stat(DEFINITIONS_PATH).st_mtime_ns:
+            with open(path, "rb") as f:
+                data = f.read()
+            registry = NodeRegistry(data)
+    except (OSError, ValueError, struct.error):
+        registry = None
+    if registry is None:
+        registry = NodeRegistry(compileRegistry(path))
+    return registry
+
+
+if __name__ == "__main__":
+    registry = NodeRegistry(compileRegistry())
+    print("compiled %d nodes, %d names and %d textures into %s" % (
+        len(registry.textures),
+        len(registry.ids),
+        len(set(texture for textures in registry.textures for texture in textures)),
+        REGISTRY_PATH,
+    ))
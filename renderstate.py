@@ -0,0 +1,255 @@
+import hashlib
+import sqlite3
+
+from constants import *
+from util import *
+
+# bump whenever the tiles a strip produces, or the blocks they are drawn from, change
+STATE_VERSION = 2
+
+# bump whenever the blocks a plot is drawn from, or how their hashes are combined, change
+PLOT_INDEX_VERSION = 1
+
+
+def checkVersion(conn, version, textures_key=None):
+    """Set up the meta table of a sidecar database and record version and textures_key
+    (see nodetable.texturesKey) in it. Returns whether the database was of that version
+    and drawn with those textures already, if not what it holds is stale"""
+    cur = conn.cursor()
+    cur.execute("CREATE TABLE IF NOT EXISTS `meta` (`key` TEXT PRIMARY KEY, `value`)")
+    cur.execute("SELECT `key`, `value` FROM `meta` WHERE `key` IN ('version', 'textures')")
+    old = dict(cur.fetchall())
+    cur.execute("INSERT OR REPLACE INTO `meta` VALUES ('version', ?), ('textures', ?)", (version, textures_key))
+    return old.get("version") == version and old.get("textures") == textures_key
+
+
+def stripTiles(x, z, steps):
+    """Yields (step, row, col) of the zoom 5 tiles stupidMakeTiles(x, z) saves in a strip of steps steps"""
+    for step in range(steps):
+        row, col = coordsToGrid(x + step, z + step)
+        if row % 4 == 0:
+            yield step, row // 4, col // 2
+
+
+def stripColumns(x, z, step):
+    """The chunk columns chunks3 draws at a step of the strip starting at (x, z)"""
+    return ((x + step, z + step), (x + step + 1, z + step), (x + step, z + step + 1))
+
+
+class RenderState(object):
+    """Sidecar database of what the base tiles in data/ were rendered from.
+
+    Every strip rendered by stupidMakeTiles is stored as its start and length. The
+    tiles it saved follow from that (see stripTiles), and so do the blocks of each
+    tile: those in the columns of the STRIP_TILE_REACH + 1 steps up to the tile's
+    own (see stripColumns). Next to it, the stamp (see Map.iterBlockStamps) and the
+    hash of every block of the map at the time of rendering, so the next run can
+    tell which blocks changed. Tiles drawn with other node definitions or textures
+    (see nodetable.texturesKey) are all stale, so then it starts over."""
+    def __init__(self, path, textures_key):
+        self.conn = sqlite3.connect(path)
+        if not checkVersion(self.conn, STATE_VERSION, textures_key):
+            self.clear()
+        cur = self.conn.cursor()
+        cur.execute("CREATE TABLE IF NOT EXISTS `blocks` (`pos` INTEGER PRIMARY KEY, `stamp` INTEGER, `hash` BLOB)")
+        cur.execute(
+            "CREATE TABLE IF NOT EXISTS `strips` (`x` INTEGER, `z` INTEGER, `steps` INTEGER, PRIMARY KEY (`x`, `z`))"
+        )
+        self.conn.commit()
+
+    def clear(self):
+        """Forget everything, the next run renders all tiles again"""
+        cur = self.conn.cursor()
+        # older versions may have had other columns
+        cur.execute("DROP TABLE IF EXISTS `blocks`")
+        cur.execute("DROP TABLE IF EXISTS `strips`")
+
+    def isEmpty(self):
+        cur = self.conn.cursor()
+        cur.execute("SELECT 1 FROM `strips` LIMIT 1")
+        return cur.fetchone() is None
+
+    def getStrips(self):
+        """List of (x, z, steps) of every rendered strip"""
+        cur = self.conn.cursor()
+        cur.execute("SELECT `x`, `z`, `steps` FROM `strips`")
+        return cur.fetchall()
+
+    def setStrip(self, x, z, steps):
+        self.conn.execute("INSERT OR REPLACE INTO `strips` VALUES (?, ?, ?)", (x, z, steps))
+
+    def removeStrip(self, x, z):
+        self.conn.execute("DELETE FROM `strips` WHERE `x` = ? AND `z` = ?", (x, z))
+
+    def changedBlocks(self, block_stamps, hash_blocks):
+        """Compare block_stamps, the (pos, stamp) of the map ordered by pos (see
+        Map.iterBlockStamps), with the recorded ones. Only blocks whose stamp changed
+        are hashed, with hash_blocks(positions) (see Map.getBlockHashes), and they only
+        count as changed if their hash did too. Deleting the block with the highest
+        stamp and saving it again gives it the same stamp again, so the recorded block
+        with the highest stamp that is still the same is hashed as well.
+        Returns a dict of pos -> (stamp, hash) of every changed or added block, None
+        for removed ones. Blocks that were saved without changing get their new stamp
+        recorded right away, committed along with everything else."""
+        cur = self.conn.cursor()
+        cur.execute("SELECT `pos`, `stamp`, `hash` FROM `blocks` ORDER BY `pos`")
+        changed = {}
+        # pos -> (stamp, recorded hash) of the blocks to hash
+        saved = {}
+        # (stamp, pos, hash) of the recorded block with the highest stamp that is still the same
+        newest = None
+        old = cur.fetchone()
+        for pos, stamp in block_stamps:
+            while old is not None and old[0] < pos:
+                changed[old[0]] = None
+                old = cur.fetchone()
+            if old is not None and old[0] == pos:
+                if stamp is None or old[1] != stamp:
+                    saved[pos] = (stamp, old[2])
+                elif newest is None or stamp > newest[0]:
+                    newest = (stamp, pos, old[2])
+                old = cur.fetchone()
+            else:
+                saved[pos] = (stamp, None)
+        while old is not None:
+            changed[old[0]] = None
+            old = cur.fetchone()
+        if newest is not None:
+            stamp, pos, old_hash = newest
+            saved[pos] = (stamp, old_hash)
+
+        hashes = hash_blocks(saved)
+        restamped = []
+        for pos, (stamp, old_hash) in saved.items():
+            block_hash = hashes.get(pos)
+            if block_hash is None:
+                # removed since
+                if old_hash is not None:
+                    changed[pos] = None
+            elif block_hash != old_hash:
+                changed[pos] = (stamp, block_hash)
+            else:
+                restamped.append((stamp, pos))
+        self.conn.executemany("UPDATE `blocks` SET `stamp` = ? WHERE `pos` = ?", restamped)
+        return changed
+
+    def updateBlocks(self, changed):
+        """Record the new stamps and hashes of changedBlocks"""
+        self.conn.executemany(
+            "DELETE FROM `blocks` WHERE `pos` = ?",
+            ((pos,) for pos, block in changed.items() if block is None),
+        )
+        self.conn.executemany(
+            "INSERT OR REPLACE INTO `blocks` VALUES (?, ?, ?)",
+            ((pos,) + block for pos, block in changed.items() if block is not None),
+        )
+
+    def commit(self):
+        self.conn.commit()
+
+
+def plotFootprint(xy_x, xy_y):
+    """The (x, z) of the blocks a plot is drawn from, see Mapper.mapAtXYWorldPlots.
+    Every one of them is drawn from y = -2 up to 9."""
+    cx = xToBlockCoordinate(xy_x)
+    cz = yToBlockCoordinate(xy_y)
+    return [(cx + x, cz - z) for z in range(8) for x in range(8)]
+
+
+def footprintPositions(plots):
+    """pos of every block plots (a list of (x, y)) are drawn from, see plotFootprint"""
+    return [getBlockAsInteger(x, y, z) for plot in plots for x, z in plotFootprint(*plot) for y in range(-2, 10)]
+
+
+def footprintHashes(block_hashes, plots):
+    """Hash of the footprint of each of plots (a list of (x, y)), from block_hashes,
+    a dict of pos -> hash of the blocks of their footprints (see PlotIndex.blockHashes).
+    Returns a dict of (x, y) -> hash"""
+    plot_of = {}
+    for plot in plots:
+        for column in plotFootprint(*plot):
+            plot_of[column] = plot
+    digests = {plot: hashlib.blake2b(digest_size=8) for plot in plots}
+    for pos, block_hash in sorted(block_hashes.items()):
+        x, y, z = getIntegerAsBlock(pos)
+        plot = plot_of.get((x, z))
+        if plot is None or not -2 <= y < 10:
+            continue
+        digests[plot].update(pos.to_bytes(8, "big", signed=True))
+        digests[plot].update(block_hash)
+    return {plot: digest.digest() for plot, digest in digests.items()}
+
+
+class PlotIndex(object):
+    """Sidecar database of the footprint hash (see footprintHashes) every plot image
+    was rendered from, per orientation, so unchanged plots don't have to be rendered again.
+    Next to it, the stamp and hash of the blocks of those footprints, as in RenderState.
+    Plots drawn with other node definitions or textures are all stale, as in RenderState."""
+    def __init__(self, path, textures_key):
+        self.conn = sqlite3.connect(path)
+        cur = self.conn.cursor()
+        cur.execute(
+            "CREATE TABLE IF NOT EXISTS `plots` (`x` INTEGER, `y` INTEGER, `orientation` INTEGER, `hash` BLOB, "
+            "PRIMARY KEY (`x`, `y`, `orientation`))"
+        )
+        cur.execute("CREATE TABLE IF NOT EXISTS `blocks` (`pos` INTEGER PRIMARY KEY, `stamp` INTEGER, `hash` BLOB)")
+        if not checkVersion(self.conn, PLOT_INDEX_VERSION, textures_key):
+            cur.execute("DELETE FROM `plots`")
+            cur.execute("DELETE FROM `blocks`")
+        self.conn.commit()
+
+    def blockHashes(self, positions, block_stamps, hash_blocks):
+        """Hash of the blocks at positions, from block_stamps, a dict of pos -> stamp of
+        those that exist (see Map.getBlockStamps). As in RenderState.changedBlocks, only
+        blocks whose stamp changed since they were recorded, and the recorded one with
+        the highest stamp that is still the same, are hashed with hash_blocks(positions)
+        (see Map.getBlockHashes), the others keep their recorded hash. Returns a dict of
+        pos -> hash, and records the new stamps and hashes, committed with commit."""
+        recorded = {
+            pos: (stamp, block_hash) for pos, stamp, block_hash in queryIn(
+                self.conn, "SELECT `pos`, `stamp`, `hash` FROM `blocks` WHERE `pos` IN (%s)", positions,
+            )
+        }
+        hashes = {}
+        saved = []
+        # (stamp, pos) of the recorded block with the highest stamp that is still the same
+        newest = None
+        for pos, stamp in block_stamps.items():
+            old = recorded.get(pos)
+            if old is None or stamp is None or old[0] != stamp:
+                saved.append(pos)
+                continue
+            hashes[pos] = old[1]
+            if newest is None or stamp > newest[0]:
+                newest = (stamp, pos)
+        if newest is not None:
+            saved.append(newest[1])
+        fresh = hash_blocks(saved)
+        for pos in saved:
+            if pos in fresh:
+                hashes[pos] = fresh[pos]
+            else:
+                # removed since
+                hashes.pop(pos, None)
+        self.conn.executemany(
+            "DELETE FROM `blocks` WHERE `pos` = ?",
+            ((pos,) for pos in recorded if pos not in hashes),
+        )
+        self.conn.executemany(
+            "INSERT OR REPLACE INTO `blocks` VALUES (?, ?, ?)",
+            ((pos, block_stamps[pos], block_hash) for pos, block_hash in fresh.items()),
+        )
+        return hashes
+
+    def getHash(self, x, y, orientation):
+        """The footprint hash the plot was last rendered from, None if it never was"""
+        cur = self.conn.cursor()
+        cur.execute("SELECT `hash` FROM `plots` WHERE `x` = ? AND `y` = ? AND `orientation` = ?", (x, y, orientation))
+        r = cur.fetchone()
+        return r[0] if r is not None else None
+
+    def setHash(self, x, y, orientation, footprint_hash):
+        self.conn.execute("INSERT OR REPLACE INTO `plots` VALUES (?, ?, ?, ?)", (x, y, orientation, footprint_hash))
+
+    def commit(self):
+        self.conn.commit()
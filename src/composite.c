@@ -274,6 +274,166 @@ alpha_over_wrap(PyObject* self, PyObject* args) {
     return ret;
 }
 
+/* alpha_over of one square sprite out of an atlas (sprites stacked
+ * vertically, one per row of size x size pixels) onto dest at (dx, dy).
+ * Touches no python objects, so it can run without the GIL.
+ */
+static inline void
+alpha_over_sprite(Imaging imDest, Imaging imAtlas, int32_t sprite,
+                  int32_t dx, int32_t dy) {
+    int32_t size = imAtlas->xsize;
+    int32_t sx = 0, sy = 0, xsize = size, ysize = size;
+    int32_t x, y;
+    uint32_t i;
+    int32_t tmp1, tmp2, tmp3;
+
+    /* clip against dest */
+    if (dx < 0) {
+        sx = -dx;
+        xsize += dx;
+        dx = 0;
+    }
+    if (dy < 0) {
+        sy = -dy;
+        ysize += dy;
+        dy = 0;
+    }
+    if (dx + xsize > imDest->xsize)
+        xsize = imDest->xsize - dx;
+    if (dy + ysize > imDest->ysize)
+        ysize = imDest->ysize - dy;
+    if (xsize <= 0 || ysize <= 0)
+        return;
+
+    sy += sprite * size;
+
+    for (y = 0; y < ysize; y++) {
+        UINT8* out = (UINT8*)imDest->image[dy + y] + dx * 4;
+        UINT8* outmask = out + 3;
+        UINT8* in = (UINT8*)imAtlas->image[sy + y] + sx * 4;
+        UINT8* inmask = in + 3;
+
+        for (x = 0; x < xsize; x++) {
+            UINT8 in_alpha = *inmask;
+
+            /* same blending as alpha_over_full with an overall_alpha of 1.0 */
+            if (in_alpha == 255 || (*outmask == 0 && in_alpha > 0)) {
+                *outmask = in_alpha;
+
+                *out = *in;
+                out++, in++;
+                *out = *in;
+                out++, in++;
+                *out = *in;
+                out++, in++;
+            } else if (in_alpha == 0) {
+                out += 3;
+                in += 3;
+            } else {
+                int32_t alpha = in_alpha + OV_MULDIV255(*outmask, 255 - in_alpha, tmp1);
+                for (i = 0; i < 3; i++) {
+                    *out = OV_MULDIV255(*in, in_alpha, tmp1) +
+                           OV_MULDIV255(OV_MULDIV255(*out, *outmask, tmp2), 255 - in_alpha, tmp3);
+
+                    *out = (*out * 255) / alpha;
+                    out++, in++;
+                }
+
+                *outmask = alpha;
+            }
+
+            out++, in++;
+            outmask += 4;
+            inmask += 4;
+        }
+    }
+}
+
+/* composites a whole block of nodes in one call
+ *
+ * draw_block(dest, atlas, node_ids, (ox, oy), swap_xz)
+ *
+ * node_ids is a 3D int32 array (any strides) in drawing order: [y][u][v],
+ * holding the atlas sprite of every node, or a negative value for nodes
+ * that are not drawn. Nodes are drawn in array order, so later ones end up
+ * on top. (ox, oy) is where the sprite of node (0, 0, 0) goes. With
+ * swap_xz, u is the x axis and v the z axis, otherwise the other way around.
+ * Returns the number of nodes drawn.
+ */
+PyObject*
+draw_block_wrap(PyObject* self, PyObject* args) {
+    PyObject *dest, *atlas, *ids;
+    int32_t ox, oy, swap_xz;
+    Imaging imDest, imAtlas;
+    Py_buffer view;
+    int32_t size, sprites, drawn = 0, bad_sprite = 0;
+    Py_ssize_t y, u, v;
+
+    if (!PyArg_ParseTuple(args, "OOO(ii)p", &dest, &atlas, &ids, &ox, &oy, &swap_xz))
+        return NULL;
+
+    imDest = imaging_python_to_c(dest);
+    imAtlas = imaging_python_to_c(atlas);
+    if (!imDest || !imAtlas)
+        return NULL;
+
+    if (strcmp(imDest->mode, "RGBA") != 0 || strcmp(imAtlas->mode, "RGBA") != 0) {
+        PyErr_SetString(PyExc_ValueError,
+                        "destination and atlas images must have mode \"RGBA\"");
+        return NULL;
+    }
+
+    size = imAtlas->xsize;
+    if (size <= 0 || imAtlas->ysize % size != 0) {
+        PyErr_SetString(PyExc_ValueError,
+                        "atlas is not a column of square sprites");
+        return NULL;
+    }
+    sprites = imAtlas->ysize / size;
+
+    if (PyObject_GetBuffer(ids, &view, PyBUF_STRIDES | PyBUF_FORMAT) != 0)
+        return NULL;
+
+    if (view.ndim != 3 || view.itemsize != 4 || strchr("il", view.format[0]) == NULL) {
+        PyBuffer_Release(&view);
+        PyErr_SetString(PyExc_ValueError,
+                        "node ids must be a 3D int32 array");
+        return NULL;
+    }
+
+    Py_BEGIN_ALLOW_THREADS
+    for (y = 0; y < view.shape[0]; y++) {
+        for (u = 0; u < view.shape[1]; u++) {
+            for (v = 0; v < view.shape[2]; v++) {
+                int32_t sprite = *(int32_t*)((char*)view.buf + y * view.strides[0] +
+                                             u * view.strides[1] + v * view.strides[2]);
+                int32_t x = swap_xz ? u : v;
+                int32_t z = swap_xz ? v : u;
+
+                if (sprite < 0)
+                    continue;
+                if (sprite >= sprites) {
+                    bad_sprite = 1;
+                    continue;
+                }
+                alpha_over_sprite(imDest, imAtlas, sprite,
+                                  ox + size / 2 * (z - x),
+                                  oy + size / 4 * (x + z - 2 * (int32_t)y));
+                drawn++;
+            }
+        }
+    }
+    Py_END_ALLOW_THREADS
+
+    PyBuffer_Release(&view);
+
+    if (bad_sprite) {
+        PyErr_SetString(PyExc_IndexError, "node id outside of the atlas");
+        return NULL;
+    }
+    return Py_BuildValue("i", drawn);
+}
+
 /* like alpha_over, but instead of src image it takes a source color
  * also, it multiplies instead of doing an over operation
  */
@@ -26,6 +26,9 @@ static PyMethodDef COverviewerMethods[] = {
     {"alpha_over", alpha_over_wrap, METH_VARARGS,
      "alpha over composite function"},
 
+    {"draw_block", draw_block_wrap, METH_VARARGS,
+     "alpha over composite of all nodes of a block from a sprite atlas"},
+
     {"resize_half", resize_half_wrap, METH_VARARGS,
      "downscale image to half size"},
 
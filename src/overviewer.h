@@ -31,7 +31,7 @@
 
 // increment this value if you've made a change to the c extension
 // and want to force users to rebuild
-#define OVERVIEWER_EXTENSION_VERSION 107
+#define OVERVIEWER_EXTENSION_VERSION 108
 
 #include <stdbool.h>
 #include <stdint.h>
@@ -60,6 +60,7 @@ PyObject* alpha_over(PyObject* dest, PyObject* src, PyObject* mask,
 PyObject* alpha_over_full(PyObject* dest, PyObject* src, PyObject* mask, float overall_alpha,
                           int32_t dx, int32_t dy, int32_t xsize, int32_t ysize);
 PyObject* alpha_over_wrap(PyObject* self, PyObject* args);
+PyObject* draw_block_wrap(PyObject* self, PyObject* args);
 PyObject* tint_with_mask(PyObject* dest, uint8_t sr, uint8_t sg,
                          uint8_t sb, uint8_t sa,
                          PyObject* mask, int32_t dx, int32_t dy, int32_t xsize, int32_t ysize);
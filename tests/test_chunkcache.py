@@ -0,0 +1,22 @@
+import os
+
+from PIL import Image
+
+from chunkcache import ChunkCache, Chunk, CHUNK_OVERHEAD
+
+
+def test_spilled_chunk_is_removed_once_read_back(tmp_path):
+    image = Image.new("RGBA", (4, 4), (1, 2, 3, 255))
+    # room for one chunk only
+    cache = ChunkCache(CHUNK_OVERHEAD + 4 * 4 * 4, str(tmp_path))
+    cache.put((0, 0, ()), Chunk(image, (0, 0), 5))
+    cache.put((0, 1, ()), Chunk(image, (0, 0), 5))
+    assert len(os.listdir(tmp_path)) == 1
+
+    chunk = cache.get((0, 0, ()))
+    assert chunk.image.tobytes() == image.tobytes()
+    assert chunk.maxy == 5
+    # (0, 1) was evicted to make room for it
+    assert len(os.listdir(tmp_path)) == 1
+    assert (0, 0, ()) not in cache.spilled
+    assert cache.get((0, 1, ())).image.tobytes() == image.tobytes()
@@ -0,0 +1,110 @@
+import os
+import os.path
+import sqlite3
+import struct
+import zlib
+
+import pytest
+import zstandard
+from PIL import Image
+
+from conftest import ROOT
+from map import Map
+from registry import loadRegistry
+from util import getBlockAsInteger
+
+
+NAMES = [b"air", b"default:stone"]
+STONE = b"".join(struct.pack(">H", 1) for i in range(4096))
+
+
+def nameIdMapping(names):
+    data = bytes([0]) + struct.pack(">H", len(names))
+    for local, name in enumerate(names):
+        data += struct.pack(">HH", local, len(name)) + name
+    return data
+
+
+def v29Block(flags, metadata=bytes([0]), names=NAMES):
+    """Raw data of a v29 block of stone (or whatever names[1] is) with the given flags
+    and node metadata list"""
+    data = bytearray([flags])
+    data += struct.pack(">HI", 0xffff, 0)
+    data += nameIdMapping(names)
+    data += bytes([2, 2]) + STONE + bytes(4096) + bytes(4096)
+    data += metadata
+    # no static objects or node timers
+    data += bytes([0]) + struct.pack(">H", 0) + bytes([10]) + struct.pack(">H", 0)
+    return bytes([29]) + zstandard.ZstdCompressor().compress(bytes(data))
+
+
+def v28Block(flags, metadata):
+    """Raw data of a v28 block of stone with the given flags and zlib-compressed node metadata"""
+    data = bytearray([28, flags]) + struct.pack(">H", 0xffff) + bytes([2, 2])
+    data += zlib.compress(STONE + bytes(8192))
+    data += metadata
+    data += bytes([0]) + struct.pack(">H", 0) + struct.pack(">I", 0)
+    data += nameIdMapping(NAMES)
+    data += bytes([10]) + struct.pack(">H", 0)
+    return bytes(data)
+
+
+def makeMap(path, blocks, node_data_only=True):
+    """A Map at path holding blocks, a dict of (x, y, z) -> raw block data"""
+    conn = sqlite3.connect(os.path.join(path, "map.sqlite"))
+    conn.execute("CREATE TABLE `blocks` (`pos` INT PRIMARY KEY, `data` BLOB)")
+    for (x, y, z), data in blocks.items():
+        conn.execute("INSERT INTO `blocks` VALUES (?, ?)", (getBlockAsInteger(x, y, z), data))
+    conn.commit()
+    conn.close()
+    return Map(path, node_data_only=node_data_only, invisible=loadRegistry().invisible)
+
+
+@pytest.fixture
+def world(tmp_path, monkeypatch):
+    """A map with a block of stone with flags 0 at (0, 0, 0) and an ungenerated one (flags 0x08) at (1, 0, 0)"""
+    monkeypatch.chdir(tmp_path)
+    os.symlink(os.path.join(ROOT, "textures"), "textures")
+    return makeMap(str(tmp_path), {(0, 0, 0): v29Block(0), (1, 0, 0): v29Block(8)})
+
+
+def test_generated_flag(world):
+    assert world.getBlock(0, 0, 0).generated
+    assert not world.getBlock(1, 0, 0).generated
+
+
+def test_invisible_block_is_empty(tmp_path):
+    map = makeMap(str(tmp_path), {(0, 0, 0): v29Block(0, names=[b"air", b"ignore"]), (1, 0, 0): v29Block(0)})
+    assert map.getBlock(0, 0, 0).is_empty
+    assert not map.getBlock(1, 0, 0).is_empty
+
+
+def test_generated_block_is_drawn(world):
+    pytest.importorskip("onomatopoeia.c_overviewer")
+    from mapper import Mapper
+    mapper = Mapper(world)
+    canvas = Image.new("RGBA", (512, 512))
+    mapper.drawBlock(canvas, 0, 0, 0, (256, 256))
+    assert mapper.drawn_blocks == 1
+    assert canvas.getbbox() is not None
+
+    canvas = Image.new("RGBA", (512, 512))
+    mapper.drawBlock(canvas, 1, 0, 0, (256 + 128, 256))
+    assert mapper.skipped_blocks == 1
+    assert canvas.getbbox() is None
+
+
+@pytest.mark.parametrize("node_data_only", [True, False])
+def test_corrupt_metadata_keeps_node_data(tmp_path, node_data_only):
+    map = makeMap(str(tmp_path), {(0, 0, 0): v28Block(0, b"not zlib at all")}, node_data_only)
+    block = map.getBlock(0, 0, 0)
+    assert (block.nodes == 1).all()
+
+
+def test_metadata_without_inventory_end(tmp_path):
+    # one metadata entry at position 0 without variables, whose inventory never ends
+    metadata = bytes([2]) + struct.pack(">HHI", 1, 0, 0) + b"List main 32\n"
+    map = makeMap(str(tmp_path), {(0, 0, 0): v29Block(0, metadata)}, node_data_only=False)
+    block = map.getBlock(0, 0, 0)
+    assert block.names[:2] == NAMES
+    assert (block.nodes == 1).all()
@@ -0,0 +1,20 @@
+import pytest
+
+import node_definitions
+from registry import compileRegistry, NodeRegistry, INVISIBLE_ID
+
+
+def test_compile(tmp_path):
+    registry = NodeRegistry(compileRegistry(str(tmp_path / "registry.bin")))
+    assert registry.ids[b"air"] == INVISIBLE_ID
+    assert b"air" in registry.invisible
+    stone = registry.ids[b"default:stone"]
+    assert registry.names[stone] == b"default:stone"
+    assert registry.textures[stone] == node_definitions.NODE_TEXTURES["default:stone"]
+    assert None not in registry.names
+
+
+def test_drawn_node_in_invisible_nodes(tmp_path, monkeypatch):
+    monkeypatch.setattr(node_definitions, "INVISIBLE_NODES", node_definitions.INVISIBLE_NODES | {b"default:stone"})
+    with pytest.raises(ValueError, match="default:stone"):
+        compileRegistry(str(tmp_path / "registry.bin"))
@@ -0,0 +1,131 @@
+import os.path
+import sqlite3
+
+import renderstate
+from map import Map
+from renderstate import RenderState, PlotIndex
+
+
+def test_plot_index_version(tmp_path, monkeypatch):
+    path = str(tmp_path / "plot_index.sqlite")
+    index = PlotIndex(path, "textures")
+    index.setHash(1, 2, 3, b"hash")
+    index.commit()
+    assert PlotIndex(path, "textures").getHash(1, 2, 3) == b"hash"
+
+    # the render state has a version of its own
+    monkeypatch.setattr(renderstate, "STATE_VERSION", renderstate.STATE_VERSION + 1)
+    assert PlotIndex(path, "textures").getHash(1, 2, 3) == b"hash"
+    monkeypatch.setattr(renderstate, "PLOT_INDEX_VERSION", renderstate.PLOT_INDEX_VERSION + 1)
+    assert PlotIndex(path, "textures").getHash(1, 2, 3) is None
+
+
+def test_plot_index_textures(tmp_path):
+    path = str(tmp_path / "plot_index.sqlite")
+    index = PlotIndex(path, "textures")
+    index.setHash(1, 2, 3, b"hash")
+    index.commit()
+    assert PlotIndex(path, "other textures").getHash(1, 2, 3) is None
+
+
+def renderedState(path):
+    state = RenderState(path, "textures")
+    state.setStrip(0, 0, 4)
+    state.updateBlocks({1: (1, b"hash")})
+    state.commit()
+    assert RenderState(path, "textures").getStrips() == [(0, 0, 4)]
+
+
+def test_render_state_version(tmp_path, monkeypatch):
+    path = str(tmp_path / "render_state.sqlite")
+    renderedState(path)
+    monkeypatch.setattr(renderstate, "STATE_VERSION", renderstate.STATE_VERSION + 1)
+    state = RenderState(path, "textures")
+    assert state.isEmpty()
+    assert state.changedBlocks([], lambda positions: {}) == {}
+
+
+def test_render_state_textures(tmp_path):
+    path = str(tmp_path / "render_state.sqlite")
+    renderedState(path)
+    state = RenderState(path, "other textures")
+    assert state.isEmpty()
+    assert state.changedBlocks([], lambda positions: {}) == {}
+
+
+class Blocks(object):
+    """A map.sqlite written to like Minetest does, see Map.iterBlockStamps"""
+    def __init__(self, path):
+        self.conn = sqlite3.connect(os.path.join(path, "map.sqlite"))
+        self.conn.execute("CREATE TABLE `blocks` (`pos` INT PRIMARY KEY, `data` BLOB)")
+        self.map = Map(path)
+        self.hashed = []
+
+    def save(self, pos, data):
+        self.conn.execute("REPLACE INTO `blocks` (`pos`, `data`) VALUES (?, ?)", (pos, data))
+        self.conn.commit()
+
+    def delete(self, pos):
+        self.conn.execute("DELETE FROM `blocks` WHERE `pos` = ?", (pos,))
+        self.conn.commit()
+
+    def changed(self, state):
+        def hashBlocks(positions):
+            self.hashed.append(sorted(positions))
+            return self.map.getBlockHashes(positions)
+        changed = state.changedBlocks(self.map.iterBlockStamps(), hashBlocks)
+        state.updateBlocks(changed)
+        state.commit()
+        return changed
+
+
+def test_changed_blocks(tmp_path):
+    blocks = Blocks(str(tmp_path))
+    state = RenderState(str(tmp_path / "render_state.sqlite"), "textures")
+    for pos in range(10):
+        blocks.save(pos, b"%d" % pos)
+    assert sorted(blocks.changed(state)) == list(range(10))
+    assert blocks.changed(state) == {}
+    # only the newest block, whose stamp can be reused, is hashed
+    assert blocks.hashed[-1] == [9]
+
+    blocks.save(3, b"three")
+    blocks.save(4, b"4")
+    blocks.delete(5)
+    blocks.save(11, b"11")
+    assert set(blocks.changed(state)) == {3, 5, 11}
+    assert blocks.changed(state) == {}
+    assert blocks.hashed[-1] == [11]
+
+    # the newest block deleted and saved again gets its stamp back
+    stamp = dict(blocks.map.iterBlockStamps())[11]
+    blocks.delete(11)
+    blocks.save(11, b"eleven")
+    assert dict(blocks.map.iterBlockStamps())[11] == stamp
+    assert set(blocks.changed(state)) == {11}
+
+
+def test_plot_block_hashes(tmp_path):
+    blocks = Blocks(str(tmp_path))
+    index = PlotIndex(str(tmp_path / "plot_index.sqlite"), "textures")
+    for pos in range(10):
+        blocks.save(pos, b"%d" % pos)
+
+    def hashes(positions):
+        def hashBlocks(saved):
+            blocks.hashed.append(sorted(saved))
+            return blocks.map.getBlockHashes(saved)
+        return index.blockHashes(positions, blocks.map.getBlockStamps(positions), hashBlocks)
+
+    first = hashes(range(12))
+    assert sorted(first) == list(range(10))
+    assert hashes(range(12)) == first
+    # only the newest block, whose stamp can be reused, is hashed
+    assert blocks.hashed[-1] == [9]
+
+    blocks.save(3, b"three")
+    blocks.delete(4)
+    second = hashes(range(12))
+    assert blocks.hashed[-1] == [3, 9]
+    assert sorted(second) == [0, 1, 2, 3, 5, 6, 7, 8, 9]
+    assert second[3] != first[3] and second[5] == first[5]
@@ -0,0 +1,30 @@
+import random
+
+import pytest
+
+pytest.importorskip("onomatopoeia.c_overviewer")
+from topdown import topdownTiles
+
+
+@pytest.mark.parametrize("blocks_per_tile", [1, 3, 8, 24])
+def test_tiles_of_ordered_positions(blocks_per_tile):
+    rng = random.Random(blocks_per_tile)
+    positions = sorted(
+        {(rng.randrange(-40, 40), rng.randrange(-3, 3), rng.randrange(-60, 60)) for i in range(3000)},
+        key=lambda position: (position[2], position[1], position[0]),
+    )
+    expected = {}
+    for x, y, z in positions:
+        expected.setdefault(((-z - 1) // blocks_per_tile, x // blocks_per_tile), set()).add((x, y, z))
+    for x, y, z in positions:
+        # the blocks just north of a tile
+        tile = ((-z - 1) // blocks_per_tile + 1, x // blocks_per_tile)
+        if z % blocks_per_tile == 0 and tile in expected:
+            expected[tile].add((x, y, z))
+
+    tiles = list(topdownTiles(iter(positions), blocks_per_tile))
+    assert len(tiles) == len(expected)
+    assert {tile: set(tile_positions) for tile, tile_positions in tiles} == expected
+    # the last row first, see PyramidRowSchedule
+    rows = [row for (row, col), tile_positions in tiles]
+    assert rows == sorted(rows, reverse=True)
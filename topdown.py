@@ -0,0 +1,233 @@
+import time
+import multiprocessing
+from collections import deque
+
+import numpy
+from PIL import Image
+
+from map import Map
+from pyramid import Pyramid, PyramidRowSchedule
+from nodetable import loadNodeTable
+from constants import *
+from util import *
+from registry import loadRegistry
+
+# where the tiles are saved, next to data/ so the isometric ones are left alone
+TOPDOWN_ROOT = "topdown"
+
+# pixels per node the tiles can be drawn with, a tile has to cover a whole number of blocks
+TOPDOWN_SCALES = tuple(
+    n for n in range(1, BLOCK_SIZE // NODES_PER_BLOCK + 1) if BLOCK_SIZE // NODES_PER_BLOCK % n == 0
+)
+
+# brightness change per node of height difference to the northern neighbour, and its limit
+HEIGHT_SHADING = 0.05
+MAX_HEIGHT_SHADING = 0.3
+
+
+def topmost(ids, mask):
+    """Local y and id of the topmost node of each column of a [z][y][x] block where mask
+    is set, as [z][x] arrays, -1 where it isn't set anywhere in the column"""
+    found = mask.any(axis=1)
+    y = NODES_PER_BLOCK - 1 - mask[:, ::-1, :].argmax(axis=1)
+    node = numpy.take_along_axis(ids, y[:, None, :], axis=1)[:, 0, :]
+    return numpy.where(found, y, -1), numpy.where(found, node, -1)
+
+
+def topdownTiles(positions, blocks_per_tile):
+    """Group the (x, y, z) of the blocks in positions, ordered by z (as Map.iterBlockPositions
+    yields them), by the base tile (row, col) of TopDownMapper they are drawn in. Yields
+    ((row, col), positions) a row of tiles at a time, so only two rows are ever held.
+    Tiles also get the blocks just north of them, which only shade their first rows."""
+    row = None
+    tiles = {}
+    # the row just south of row, waiting for the blocks north of it
+    south = {}
+    for x, y, z in positions:
+        tile_row = (-z - 1) // blocks_per_tile
+        if tile_row != row:
+            yield from south.items()
+            south = {}
+            if row == tile_row + 1:
+                south = tiles
+            else:
+                yield from tiles.items()
+            row = tile_row
+            tiles = {}
+        if z % blocks_per_tile != 0 and south:
+            # past the blocks north of the row to the south
+            yield from south.items()
+            south = {}
+        tiles.setdefault((row, x // blocks_per_tile), []).append((x, y, z))
+        tile = south.get((row + 1, x // blocks_per_tile))
+        if tile is not None:
+            tile.append((x, y, z))
+    yield from south.items()
+    yield from tiles.items()
+
+
+class TopDownMapper(StatCounters):
+    """Draws the map from straight above: scale x scale pixels per node column in the
+    average colour (see nodetable.py) of its topmost node, blended over the topmost
+    opaque node below when that one is see-through. The tiles are saved in TOPDOWN_ROOT
+    with the layout of Mapper's, so html/map.html?topdown shows them: base tile (row, col) covers the blocks with x from
+    col * B to col * B + B - 1 and z from -(row + 1) * B to -row * B - 1, north up,
+    with B = blocks_per_tile. With shading, slopes facing north are drawn brighter and
+    those facing south darker."""
+    # the counters that are summed up over worker processes
+    STAT_COUNTERS = ("cnt", "drawn_blocks", "skipped_blocks")
+
+    def __init__(self, map, scale=1, shading=False, tile_cache_bytes=0):
+        self.map = map
+        self.scale = scale
+        self.shading = shading
+        self.blocks_per_tile = BLOCK_SIZE // (NODES_PER_BLOCK * scale)
+        # keeps the tiles around for joining the zoom levels when that happens in this process
+        self.pyramid = Pyramid(tile_cache_bytes, TOPDOWN_ROOT)
+        self.cnt = 0
+        self.drawn_blocks = 0
+        self.skipped_blocks = 0
+        self.set_up_colours()
+
+    def set_up_colours(self):
+        """Colour of every node seen from above, indexed by the same ids Mapper gives them.
+        The extra last entry is transparent, for nodes that are not drawn."""
+        # invisible nodes have id -1, the extra last entry
+        self.node_ids = loadRegistry().ids
+        self.unknown_node_id = self.node_ids[b"UNKNOWN_NODE"]
+        self.colours = numpy.vstack([loadNodeTable()["top_colour"], numpy.zeros((1, 4), dtype=numpy.uint8)])
+
+    def nodeId(self, node_name):
+        return self.node_ids.get(node_name, self.unknown_node_id)
+
+    def blockTops(self, map_block):
+        """topmost of the visible and of the opaque nodes of a block"""
+        ids = numpy.array([self.nodeId(name) for name in map_block.names], dtype=numpy.int32)[map_block.local_nodes()]
+        alpha = self.colours[ids, 3]
+        return topmost(ids, alpha > 0), topmost(ids, alpha == 255)
+
+    def makeTile(self, row, col, positions):
+        """Draw the base tile at (row, col) from the blocks at positions (see topdownTiles),
+        None if nothing is drawn on it"""
+        n = NODES_PER_BLOCK
+        size = self.blocks_per_tile * n
+        # one more row of blocks to the north, for the shading of the first rows
+        height = numpy.zeros((size + n, size), dtype=numpy.int32)
+        top = numpy.full((size + n, size), -1, dtype=numpy.int32)
+        opaque = numpy.full((size + n, size), -1, dtype=numpy.int32)
+        blocks = self.map.getBlocks(positions)
+        # from the top down, so the first node found in a column is the topmost one
+        for bx, by, bz in sorted(positions, key=lambda position: -position[1]):
+            map_block = blocks[(bx, by, bz)]
+            if map_block.is_empty or not map_block.generated:
+                self.skipped_blocks += 1
+                continue
+            self.drawn_blocks += 1
+            (top_y, top_id), (_, opaque_id) = self.blockTops(map_block)
+            # image rows go north to south, z goes south to north
+            r = (-row * self.blocks_per_tile - bz) * n
+            c = (bx - col * self.blocks_per_tile) * n
+            area = (slice(r, r + n), slice(c, c + n))
+            new = (top[area] < 0) & (top_id[::-1] >= 0)
+            top[area][new] = top_id[::-1][new]
+            height[area][new] = by * n + top_y[::-1][new]
+            new = (opaque[area] < 0) & (opaque_id[::-1] >= 0)
+            opaque[area][new] = opaque_id[::-1][new]
+        if not (top[n:] >= 0).any():
+            return None
+
+        colour = self.colours[top].astype(numpy.float64)
+        below = self.colours[opaque].astype(numpy.float64)
+        alpha = numpy.where(opaque >= 0, colour[..., 3] / 255, 1.0)[..., None]
+        rgb = colour[..., :3] * alpha + below[..., :3] * (1 - alpha)
+        if self.shading:
+            north = numpy.vstack([height[:1], height[:-1]])
+            north_top = numpy.vstack([top[:1], top[:-1]])
+            slope = numpy.where((top >= 0) & (north_top >= 0), height - north, 0)
+            rgb *= numpy.clip(1 + HEIGHT_SHADING * slope, 1 - MAX_HEIGHT_SHADING, 1 + MAX_HEIGHT_SHADING)[..., None]
+        pixels = numpy.empty((size + n, size, 4), dtype=numpy.uint8)
+        pixels[..., :3] = numpy.clip(rgb, 0, 255).round()
+        pixels[..., 3] = numpy.where(opaque >= 0, 255, colour[..., 3])
+        pixels = pixels[n:]
+        if self.scale > 1:
+            pixels = pixels.repeat(self.scale, axis=0).repeat(self.scale, axis=1)
+        self.cnt += 1
+        return Image.fromarray(pixels, "RGBA")
+
+    def summary(self):
+        return "drew %d top-down tiles from %d blocks, skipped %d empty, missing or ungenerated blocks" % (
+            self.cnt,
+            self.drawn_blocks,
+            self.skipped_blocks,
+        )
+
+
+# the mapper running in a worker process, see init_worker
+worker_mapper = None
+
+
+def init_worker(map_folder, cache_bytes, scale, shading):
+    global worker_mapper
+    worker_mapper = TopDownMapper(Map(map_folder, cache_bytes, invisible=loadRegistry().invisible), scale, shading)
+
+
+def render_tile(task, mapper=None):
+    """Draw and save a base tile, given as (row, col, positions), in a worker process
+    unless a mapper is passed. Returns (row, col), whether it was saved (it isn't if it
+    is empty) and the counters of the work done."""
+    mapper = mapper or worker_mapper
+    row, col, positions = task
+    tile = mapper.makeTile(row, col, positions)
+    if tile is None:
+        return (row, col), False, mapper.takeStats()
+    mapper.pyramid.saveTile(tile, row, col)
+    return (row, col), True, mapper.takeStats()
+
+
+def imapBounded(pool, func, tasks, ahead):
+    """Like pool.imap, but taking at most ahead tasks from tasks before their results are
+    asked for, so tasks can be a stream of more than fits in memory"""
+    pending = deque()
+    for task in tasks:
+        pending.append(pool.apply_async(func, (task,)))
+        if len(pending) >= ahead:
+            yield pending.popleft().get()
+    while pending:
+        yield pending.popleft().get()
+
+
+def render_topdown(mapper, args):
+    """Draw every base tile of the map with args.jobs processes and join the zoom levels,
+    each tile as soon as the rows of tiles below it are done"""
+    work = (
+        (row, col, positions)
+        for (row, col), positions in topdownTiles(mapper.map.iterBlockPositions(), mapper.blocks_per_tile)
+    )
+    if args.jobs > 1:
+        pool = multiprocessing.Pool(
+            args.jobs,
+            initializer=init_worker,
+            initargs=(args.map_folder, args.block_cache_mb * 1024 * 1024, mapper.scale, mapper.shading),
+        )
+        results = imapBounded(pool, render_tile, work, 2 * args.jobs)
+    else:
+        pool = None
+        results = (render_tile(task, mapper) for task in work)
+    schedule = PyramidRowSchedule(mapper.pyramid)
+    done = 0
+    time_last_message = time.perf_counter()
+    for (row, col), saved, stats in results:
+        done += 1
+        # the tiles come a row at a time, the last row first
+        schedule.done(row)
+        if saved:
+            schedule.saved(row, col)
+        mapper.addStats(stats)
+        time_current = time.perf_counter()
+        if time_current - time_last_message > 1.0:
+            print(f"{done} tiles done")
+            time_last_message = time_current
+    if pool is not None:
+        pool.close()
+        pool.join()
+    schedule.done()
@@ -1,3 +1,9 @@
+import contextlib
+import os
+import os.path
+import struct
+
+
 def getBlockAsInteger(x, y, z):
     return z * 16777216 + y * 4096 + x
 
@@ -18,20 +24,114 @@ def getIntegerAsBlock(i):
     return x,y,z
 
 
-def readU8(f):
-    return ord(f.read(1))
-
-
-def readU16(f):
-    return ord(f.read(1)) * 256 + ord(f.read(1))
-
-
-def readU32(f):
-    return ord(f.read(1)) * 256 * 256 * 256 + ord(f.read(1)) * 256 * 256 + ord(f.read(1)) * 256 + ord(f.read(1))
-
-
-def readS32(f):
-    return unsignedToSigned(ord(f.read(1)) * 256 * 256 * 256 + ord(f.read(1)) * 256 * 256 + ord(f.read(1)) * 256 + ord(f.read(1)), 2 ** 31)
+# stay well below SQLITE_MAX_VARIABLE_NUMBER (999 on older sqlite builds)
+QUERY_BATCH_SIZE = 500
+
+
+def queryIn(conn, query, keys):
+    """Yields the rows of query, whose only parameter is an IN (%s), for all of keys,
+    in as few queries as sqlite allows"""
+    keys = list(keys)
+    cur = conn.cursor()
+    for i in range(0, len(keys), QUERY_BATCH_SIZE):
+        batch = keys[i:i + QUERY_BATCH_SIZE]
+        cur.execute(query % ",".join("?" * len(batch)), batch)
+        yield from cur
+
+
+@contextlib.contextmanager
+def replacingFile(path):
+    """Open a temporary file next to path for writing, which replaces path once it is
+    written. Other processes may be loading or writing path at the same time, so it is
+    only ever replaced in one go."""
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    temporary = "%s.%d.tmp" % (path, os.getpid())
+    with open(temporary, "wb") as f:
+        yield f
+    os.replace(temporary, path)
+
+
+class StatCounters(object):
+    """takeStats and addStats for the counters named in STAT_COUNTERS, so those of
+    worker processes can be summed up in the main one. Counters are numbers or
+    collections.Counter, or other StatCounters whose counters are taken along."""
+    STAT_COUNTERS = ()
+
+    def takeStats(self):
+        """Return the counters and reset them, see addStats"""
+        stats = {}
+        for name in self.STAT_COUNTERS:
+            value = getattr(self, name)
+            if isinstance(value, StatCounters):
+                stats[name] = value.takeStats()
+            else:
+                stats[name] = value
+                setattr(self, name, type(value)())
+        return stats
+
+    def addStats(self, stats):
+        """Add counters taken from another instance (e.g. in a worker process)"""
+        for name in self.STAT_COUNTERS:
+            value = getattr(self, name)
+            if isinstance(value, StatCounters):
+                value.addStats(stats[name])
+            else:
+                setattr(self, name, value + stats[name])
+
+
+U16 = struct.Struct(">H")
+U32 = struct.Struct(">I")
+S32 = struct.Struct(">i")
+
+
+class Reader(object):
+    """Cursor over a bytes-like object reading big-endian values, without copying the data"""
+    def __init__(self, data, pos=0):
+        self.data = data
+        self.view = memoryview(data)
+        self.pos = pos
+
+    def u8(self):
+        value = self.view[self.pos]
+        self.pos += 1
+        return value
+
+    def u16(self):
+        value, = U16.unpack_from(self.view, self.pos)
+        self.pos += 2
+        return value
+
+    def u32(self):
+        value, = U32.unpack_from(self.view, self.pos)
+        self.pos += 4
+        return value
+
+    def s32(self):
+        value, = S32.unpack_from(self.view, self.pos)
+        self.pos += 4
+        return value
+
+    def unpack(self, fmt):
+        """Read several values at once with a precompiled struct.Struct"""
+        values = fmt.unpack_from(self.view, self.pos)
+        self.pos += fmt.size
+        return values
+
+    def read(self, n):
+        """Returns a memoryview of the next n bytes"""
+        value = self.view[self.pos:self.pos + n]
+        self.pos += n
+        return value
+
+    def skip(self, n):
+        self.pos += n
+
+    def rest(self):
+        return self.view[self.pos:]
+
+    def find(self, sub):
+        """Position of the next occurrence of sub, or -1"""
+        return self.data.find(sub, self.pos)
 
 
 def gridToCoords(row, col):